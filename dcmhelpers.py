@@ -12,12 +12,12 @@ Functionality:
 '''
 import sys
 import os
-import time
 import datetime
-import json
-from tkinter import *
-from tkinter.filedialog import askopenfilename, asksaveasfilename, askdirectory
-import requests
+import xml.etree.ElementTree as ElementTree
+from locgov import get_client, loads_json, LocGovFetchError, RetryableError
+
+MARCXML_NAMESPACE = 'http://www.loc.gov/MARC21/slim'
+MARCXML_RECORD = '{%s}record' % MARCXML_NAMESPACE
 
 def testResult(continued='unknown', prompt='Did the first result of whatever you are automating work? Enter "Y" or "N":'):
     '''Functionality: Facilitate a loop that asks a user if the loop resulted in the desired outcome.
@@ -52,6 +52,8 @@ def getInputFileGUI(prompt="Select a file:"):
     Returns:
         -inFile; a string containing the filepath selected by the user
     '''
+    from tkinter import Tk
+    from tkinter.filedialog import askopenfilename
     root = Tk()
     ftypes = [
         ('All files', '*'),
@@ -70,6 +72,8 @@ def saveFileGUI(prompt="Save file as:"):
     Returns:
         -outFile; a string containing the filepath input by the user
     '''
+    from tkinter import Tk
+    from tkinter.filedialog import asksaveasfilename
     root = Tk()
     ftypes = [
         ('All files', '*'),
@@ -89,6 +93,8 @@ def saveInDirectory(prompt="Select a directory to save the output file in:"):
     Returns:
         -outPath; a string containing the directory path input by the user
     '''
+    from tkinter import Tk
+    from tkinter.filedialog import askdirectory
     root = Tk()
     outPath = askdirectory(title = prompt)
     root.destroy()
@@ -139,49 +145,46 @@ def testRequiredInput(fieldnames, required_fieldnames):
         print('Script exiting.')
         sys.exit()
 
-def get_loc_gov_json(itemID, headers = {'Accept': 'application/json'}):
+def get_loc_gov_json(itemID, headers = {'Accept': 'application/json'}, quiet=False):
     '''Functionality: Get Loc.gov JSON metadata for an item.
     Requests JSON from loc.gov and returns the metadata as a dictonary.
+    Connection errors, timeouts, throttling and server errors are retried with backoff under the shared locgov client's retry policy.
     If errors are encountered, they are reported to the user without raising an exception.
     !!!This function is experimental and could use some evaluation and refinement!!!
     Parameters:
         -itemID; loc.gov item identifer as a string or integer
         -headers; value for python requests library parameter. Default value == {'Accept': 'application/json'}
+        -quiet; if True, only problems are printed, not each item requested. Default value == False
     Returns:
         -data: a dictonary or string containing the results of the request
             =dictonary if request is successful
             ='Error' if request was unsuccessful
     '''
-    print("getting json from LOC.gov for item:", itemID)
+    if not quiet:
+        print("getting json from LOC.gov for item:", itemID)
     tested_item = str(itemID).replace(' ','')
     #use the lccn to get the Loc.gov catalog json
     url = 'https://www.loc.gov/item/' + tested_item + '/?fo=json'
+    def parse(response):
+        # loc.gov's error page is transient, so it is retried (and slows the rate limiter) like any other
+        if 'seeing this error' in response.text:
+            raise RetryableError('loc.gov error page')
+        try:
+            return loads_json(response.content)
+        except ValueError:
+            if response.status_code == 404:
+                return {'status': 404}
+            raise RetryableError('Response was not JSON')
     try:
-        data = None
-        while data is None:
-            try:
-                response = requests.get(url, headers=headers)
-                if 'seeing this error' in response.text:
-                    data = "Error"
-                else:
-                    data = json.loads(response.text)
-            except:
-                print('LOC.gov response is taking longer than expected, waiting 5 seconds to retry request')
-                time.sleep(5)
-                pass
-            try:
-                if data == 'Error':
-                    print('Error retrieving JSON from LOC.gov for this item:', itemID)
-                    return data
-                elif 'status' in data and data['status'] == 404:
-                    print('404 error on LOC.gov for this item:', itemID)
-                    return data
-                else:
-                    return data
-            except:
-                print('Unexpected error with data from this item:', itemID)
-                data = 'Error'
-                return data
+        data = get_client().fetch(url, headers=headers, parse=parse, endpoint='item')
+        if data == 'Error':
+            print('Error retrieving JSON from LOC.gov for this item:', itemID)
+        elif 'status' in data and data['status'] == 404:
+            print('404 error on LOC.gov for this item:', itemID)
+        return data
+    except LocGovFetchError as e:
+        print('Could not get JSON from LOC.gov for this item:', itemID, e.reason)
+        return "Error"
     except:
         print('getLOCGOVjson function failed on this item:', itemID)
         print('Review the function for bugs and try again.')
@@ -191,6 +194,7 @@ def get_loc_gov_json(itemID, headers = {'Accept': 'application/json'}):
 def get_marcxml_from_loc_gov_json(loc_gov_json):
     '''Functionality: Use an item's loc.gov JSON metadata dictonary to get its MARCXML data.
     Requests MARCXML from loc.gov and returns the metadata as a string.
+    Failed requests are retried with backoff under the shared locgov client's retry policy.
     If errors are encountered, they are reported to the user without raising an exception.
     !!!This function is experimental and could use some evaluation and refinement!!!
     Parameters:
@@ -200,31 +204,71 @@ def get_marcxml_from_loc_gov_json(loc_gov_json):
         -None: if request was unsuccessful
     '''
     try:
-        formats = loc_gov_json['item']['other_formats']
-        for formt in formats:
-            #if a link to the marcxml exists, record that value in a variable for the log, and get the xml
-            if formt['label'] == "MARCXML Record":
-                MARCXMLurl = formt['link']
-                try:
-                    data = None
-                    while data is None:
-                        try:
-                            print('getting marcXML from URL:', MARCXMLurl)
-                            response = requests.get(str(MARCXMLurl))
-                            xml = response.content
-                            return xml
-                        except:
-                            print('XML response is taking longer than expected, waiting 5 seconds to retry request')
-                            t.sleep(5)
-                            pass
-                except:
-                    print('Unexpected error getting XML for URL', MARCXMLurl)
+        MARCXMLurl = get_marcxml_link(loc_gov_json)
     except KeyError as e:
         print('Tried to get marcXML, but JSON from LOC.gov does not have the following needed data:', e)
         return None
-    else:
+    if MARCXMLurl == None:
         print('No link to XML in LOC.gov JSON')
         return None
+    try:
+        print('getting marcXML from URL:', MARCXMLurl)
+        response = get_client().fetch(str(MARCXMLurl), headers={'Accept': '*/*'}, endpoint='marcxml')
+        xml = response.content
+        return xml
+    except LocGovFetchError as e:
+        print('Could not get XML for URL', MARCXMLurl, e.reason)
+    except:
+        print('Unexpected error getting XML for URL', MARCXMLurl)
+    return None
+
+def get_marcxml_link(loc_gov_json):
+    '''Functionality: Find the link to an item's MARCXML record in its loc.gov JSON metadata dictonary.
+    Parameters:
+        -loc_gov_json; loc.gov JSON dictonary (probably output of get_loc_gov_json())
+    Returns:
+        -link: a string containing the MARCXML URL, from the "MARCXML Record" entry of the item's other_formats
+        -None: if the item has no MARCXML link
+    Raises KeyError if the JSON has no item other_formats
+    '''
+    for formt in loc_gov_json['item']['other_formats']:
+        if formt['label'] == "MARCXML Record":
+            return formt['link']
+    return None
+
+def iter_marcxml_records(url, headers={'Accept': '*/*'}):
+    '''Functionality: Stream MARCXML from loc.gov and yield its MARC records one at a time as they download,
+    so the whole response is never held in memory. Works for a single record or a MARC collection.
+    Failed requests, and loc.gov's HTML error page, are retried with backoff under the shared locgov client's retry policy.
+    Parameters:
+        -url; a string containing the MARCXML URL (probably output of get_marcxml_link())
+        -headers; value for python requests library parameter. Default value == {'Accept': '*/*'}
+    Returns (yields):
+        -record: an xml.etree.ElementTree Element for each MARC record, in document order.
+            Each is cleared once the next is read, so use it before asking for the next.
+            Nothing is yielded if the URL is 404.
+    Raises locgov.LocGovFetchError if the URL can't be fetched, and xml.etree.ElementTree.ParseError if it isn't XML
+    '''
+    def check(response):
+        # An HTML page in place of the MARCXML is loc.gov's transient error page, so it is retried
+        if response.status_code != 404 and 'html' in response.headers.get('Content-Type', ''):
+            response.close()
+            raise RetryableError('loc.gov error page')
+        return response
+    response = get_client().fetch(str(url), headers=headers, parse=check, stream=True, endpoint='marcxml')
+    try:
+        if response.status_code == 404:
+            return
+        parser = ElementTree.XMLPullParser(events=['end'])
+        for chunk in response.iter_content(65536):
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if element.tag == MARCXML_RECORD or element.tag == 'record':
+                    yield element
+                    element.clear()
+        parser.close()
+    finally:
+        response.close()
 
 def run_service():
     '''Functionality: Get input from a user that indicates if a script should send API service requests,
@@ -2,41 +2,216 @@
 # encoding: utf-8
 
 # Pull Item and Resource CSVs from loc.gov JSON
-# Follow prompts in script for data inputs
+# Follow prompts in script for data inputs, or give them as arguments (see --help)
+# Ex: loc-gov-json.py --batch --method collection --value rare-book-selections --output-dir out
 # See: https://staff.loc.gov/wikis/display/DCMSection/Pull+loc.gov+JSON+data+for+Items+and+Resources
 
 import sys
-import csv
 import os
 import json
+import argparse
+import collections.abc
+import logging
+import subprocess
+import threading
+import time
 import requests
 from dcmhelpers import *
 from locgov import *
-import timeit
+from locgovarchive import *
+from locgovcache import *
+from locgovcheckpoint import *
+from locgovinput import *
+from locgovmanifest import *
+from locgovmarc import *
+from locgovmetrics import *
+from locgovpartition import *
+from locgovsegments import *
+from locgovseen import *
+from locgovshard import *
+from locgovwriters import *
+
+logger = logging.getLogger('locgov.harvest')
 
 # TO ADD:
 # output p1_item_id
 
 
+# Search result fields each output column is built from
+# Columns not listed here don't come from the search result
+RESULT_FIELDS = {
+    'p1_item_id': ['id'],
+    'p1_item': ['id'],
+    'p1_resource_count': ['resources'],
+    'p1_resource': ['resources'],
+    'etl_aggregate': ['resources'],
+    'p1_resource_id': ['resources'],
+    'p1_resource_caption': ['resources'],
+    'p1_resource_segment_count': ['resources'],
+    'has_fulltext': ['resources'],
+    'representative_index': ['resources'],
+    'p1_resource_segment_with_text': ['resources'],
+    'p1_resource_file_count': ['resources'],
+    'p1_resource_files_by_use': ['resources'],
+    'p1_resource_files_by_mimetype': ['resources'],
+    'p1_resource_file_bytes': ['resources'],
+    'p1_resource_has_fulltext_file': ['resources'],
+    'p1_resource_has_iiif': ['resources'],
+    'digitized': ['digitized'],
+    'number_lccn': ['number_lccn'],
+    'number_fileID': ['number_fileID'],
+    'number_uuid': ['number_uuid'],
+    'online_format': ['online_format'],
+    'mime_type': ['mime_type'],
+    'partof': ['partof'],
+    'group': ['group'],
+}
+
+# Build the at= projection for search result pages from the output columns
+# so loc.gov only sends the result fields write_resource_rows uses
+# Ex: results.id,results.resources,results.digitized
+def results_projection(fieldnames):
+    fields = ['id']
+    for fieldname in fieldnames:
+        for field in RESULT_FIELDS.get(fieldname, []):
+            if field not in fields:
+                fields.append(field)
+    return ','.join('results.' + field for field in fields)
+
+# Typed records from result_records
+# An ItemRecord is a dict of the item's output columns
+class ItemRecord(dict):
+    pass
+
+# A ResourceRecord holds only the resource's own columns, and refers to the item-level
+# columns (a dict shared by every resource of the item) instead of copying them,
+# so an item with thousands of resources doesn't repeat its fields thousands of times
+# It reads like a dict of all its columns, which is all the writers need
+class ResourceRecord(collections.abc.Mapping):
+    __slots__ = ('item', 'p1_resource', 'etl_aggregate', 'p1_resource_id', 'p1_resource_caption',
+        'p1_resource_segment_count', 'has_fulltext', 'representative_index') + tuple(STATS.values())
+    FIELDS = __slots__[1:]
+
+    def __init__(self, item, **fields):
+        self.item = item
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self.item[key]
+
+    def __iter__(self):
+        yield from self.item
+        for name in self.FIELDS:
+            if hasattr(self, name):
+                yield name
+
+    def __len__(self):
+        return len(self.item) + sum(1 for name in self.FIELDS if hasattr(self, name))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# Holds rows in memory so they can be built on a worker thread
+# and written in order later by the main thread
+class RowBuffer:
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+    def write_to(self, writer):
+        for row in self.rows:
+            writer.writerow(row)
+
+# Counts rows as they are written and logs a progress line every interval seconds
+# in place of printing every row
+class Progress:
+    def __init__(self, interval=30.0):
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last_log = self.start
+        self.counts = {'items': 0, 'resources': 0}
+        self.lock = threading.Lock()
+
+    # Wrap a writer so the rows written through it are counted as `kind` ('items' or 'resources')
+    def track(self, writer, kind):
+        return ProgressWriter(writer, self, kind)
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+            now = time.monotonic()
+            if now - self.last_log < self.interval:
+                return
+            self.last_log = now
+        self.log()
+
+    def log(self):
+        elapsed = time.monotonic() - self.start
+        logger.info('Progress: %d items, %d resources in %.0f seconds (%.1f items/second)',
+            self.counts['items'], self.counts['resources'], elapsed, self.counts['items'] / max(elapsed, 0.001))
+
+class ProgressWriter:
+    def __init__(self, writer, progress, kind):
+        self.writer = writer
+        self.progress = progress
+        self.kind = kind
+
+    def writeheader(self):
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.progress.count(self.kind)
+
+    def close(self):
+        self.writer.close()
+
+# Passes item rows on to the writer, and the IDs of the items harvested to a
+# locgovmarc.MarcxmlPipeline that fetches their MARCXML at the same time
+class MarcxmlTap:
+    def __init__(self, writer, pipeline):
+        self.writer = writer
+        self.pipeline = pipeline
+
+    def writeheader(self):
+        self.writer.writeheader()
+
+    # Marker rows (INVALID, ERROR, REMOVED...) aren't ItemRecords and have no record to get
+    def writerow(self, row):
+        self.writer.writerow(row)
+        if isinstance(row, ItemRecord):
+            self.pipeline.submit(row['p1_item_id'])
+
+    def close(self):
+        self.writer.close()
+
+
 # Search loc.gov based on a starting seed URL
-def paged_search(seed, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice):
-    # search_counter = '10'
-    # current_page = 1
-    # # If basic search or if a collection, weed out unnecessary JSON parts
-    # if 'loc.gov/collections/' in seed:
-    #     exclude = '&at!=expert_resources,topics,featured_items,facet_views,views,pages,next,content,next_sibling,previous_sibling,facets'
-    # if 'loc.gov/search' in seed:
-    #     exclude = '&at!=views,facet_views,facets'
-    # # Build up the URL based on the excludes, results per page, and current page
-    # url_args = '&fo=json&all=true&c=' + search_counter + exclude
-    # url_page = '&sp=' + str(current_page)
-    # search_url = seed + url_args
-    # starter_url = search_url + url_page
-
-    search_counter = '10'
+# page_workers sets how many result pages are requested at the same time
+# checkpoint is an optional locgovcheckpoint.Checkpoint; pages it has already recorded are skipped
+# page_size is the number of results per page, and projection the at= value for result pages
+# (see results_projection to request only the fields the output needs)
+def paged_search(seed, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, page_workers=1, checkpoint=None, page_size=10, projection='results', manifest_dir=None, seen=None, query_hits=None):
+    search_counter = str(page_size)
     current_page = 1
+    if checkpoint is not None:
+        if checkpoint.query_is_done(seed):
+            logger.info('Already harvested, skipping: %s', seed)
+            return
+        current_page = checkpoint.last_page(seed) + 1
+    # In incremental mode only results that are new or changed since the last run are written
+    manifest = None
+    if manifest_dir is not None:
+        manifest = open_manifest(manifest_dir, seed)
     url_args = '&fo=json&all=true&c=' + search_counter
-    url_page = '&sp=' + str(current_page)
     search_url = seed + url_args
     starter_url = search_url + '&at=pagination,search'
 
@@ -46,41 +221,230 @@ def paged_search(seed, item_writer, resource_writer, catalog_option, locgov_serv
     pages = starter_search['pagination']
     total_pages = pages['total']
 
-    print('Search query: ', totals['in'])
-    print('Total hits: ', totals['hits'])
-    print('Total pages: ', total_pages)
+    logger.info('Search query: %s', totals['in'])
+    logger.info('Total hits: %s', totals['hits'])
+    logger.info('Total pages: %s', total_pages)
 
     if totals['hits'] == 0:
+        write_no_result_rows(seed, item_writer, resource_writer)
+    else:
+        # Get one page of results and build its rows
+        # Runs on a worker thread when page_workers > 1, so rows are buffered rather than written
+        def fetch_page(page):
+            this_url = search_url + '&sp=' + str(page) + '&at=' + projection
+            return search_page_rows(this_url, seed, catalog_option, locgov_server, segments_option_choice, manifest, seen, query_hits)
+
+        # Proceed with search for each page of results
+        # Pages are fetched up to page_workers at a time, but written in page order
+        pages_todo = range(current_page, total_pages + 1)
+        for page, (page_items, page_resources, page_hits) in zip(pages_todo, bounded_map(fetch_page, pages_todo, page_workers)):
+            page_items.write_to(item_writer)
+            page_resources.write_to(resource_writer)
+            if query_hits is not None:
+                page_hits.write_to(query_hits)
+            if checkpoint is not None:
+                checkpoint.page_done(seed, page)
+
+    # Removals can only be told when every page was seen by this run, not after a resume part way through
+    finish_search(seed, item_writer, resource_writer, checkpoint, manifest, current_page == 1)
+
+# Search loc.gov split into facet partitions (see locgovpartition), for searches too deep to page through
+# facets are the facet names to split on in turn, and max_pages the deepest a partition may be
+# before it is split on the next facet
+# Every partition's pages are fetched up to page_workers at a time, written partition by partition;
+# the checkpoint records each partition's pages under its own seed URL
+# Items in more than one partition are written once, and once every partition is harvested the
+# distinct items found are reconciled against the search's hits
+# Each split has a complement partition for items without a listed value; if a facet had none
+# and the partitions missed some items, the search is swept for them, but only as deep as a
+# partition may go (max_pages), and any still missing are reported
+def partitioned_search(seed, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, facets, max_pages=DEFAULT_PARTITION_PAGES, page_workers=1, checkpoint=None, page_size=10, projection='results', manifest_dir=None, seen=None, query_hits=None):
+    if checkpoint is not None and checkpoint.query_is_done(seed):
+        logger.info('Already harvested, skipping: %s', seed)
+        return
+    manifest = None
+    if manifest_dir is not None:
+        manifest = open_manifest(manifest_dir, seed)
+    url_args = '&fo=json&all=true&c=' + str(page_size)
+
+    hits, partitions, covered = plan_partitions(seed, facets, page_size, max_pages, page_workers)
+    logger.info('Search query: %s', seed)
+    logger.info('Total hits: %s', hits)
+    logger.info('Partitions: %d, deepest %d pages', len(partitions), max([partition.pages for partition in partitions] or [0]))
+
+    complete = True
+    if hits == 0:
+        write_no_result_rows(seed, item_writer, resource_writer)
+    else:
+        # Distinct items found by this search, whether written or skipped
+        found = SeenItems()
+
+        def fetch_page(job):
+            partition, page = job
+            this_url = partition.seed + url_args + '&sp=' + str(page) + '&at=' + projection
+            return search_page_rows(this_url, seed, catalog_option, locgov_server, segments_option_choice, manifest, seen, query_hits, found)
+
+        def harvest_pages(partitions):
+            jobs = []
+            for partition in partitions:
+                first_page = 1
+                if checkpoint is not None:
+                    first_page = checkpoint.last_page(partition.key) + 1
+                jobs += [(partition, page) for page in range(first_page, partition.pages + 1)]
+            for (partition, page), (page_items, page_resources, page_hits) in zip(jobs, bounded_map(fetch_page, jobs, page_workers)):
+                page_items.write_to(item_writer)
+                page_resources.write_to(resource_writer)
+                if query_hits is not None:
+                    page_hits.write_to(query_hits)
+                if checkpoint is not None:
+                    checkpoint.page_done(partition.key, page)
+
+        # A resumed run has lost the items found before it stopped, so it can't reconcile them;
+        # without complements it sweeps as it would for missing items (skipping the items already
+        # written, which are in seen), and one stopped during the sweep finishes it
+        sweep = Partition(seed, hits, min(-(-hits // page_size), max_pages), 'sweep', key=seed + '#sweep')
+        partitioned = [partition.seed for partition in partitions] != [seed]
+        if checkpoint is not None:
+            complete = not any(checkpoint.last_page(partition.key) for partition in partitions + [sweep])
+        if checkpoint is not None and checkpoint.last_page(sweep.key):
+            harvest_pages([sweep])
+        else:
+            harvest_pages(partitions)
+            if partitioned and not covered and (not complete or len(found) < hits):
+                logger.warning('Partitions found %d of %d hits, sweeping the first %d pages of the search for the rest',
+                    len(found), hits, sweep.pages)
+                harvest_pages([sweep])
+        if complete:
+            logger.info('Reconciled: %d distinct items found for %d hits', len(found), hits)
+            if len(found) < hits:
+                logger.warning('%d hits were not found; the search may have changed during the run, '
+                    'or its facets left them out', hits - len(found))
+                complete = False
+        else:
+            logger.info('Resumed part way through, so the items found can\'t be reconciled with the %d hits', hits)
+    finish_search(seed, item_writer, resource_writer, checkpoint, manifest, complete)
+
+# Get one page of search results and build its rows in RowBuffers: (items, resources, query hits)
+# Results unchanged since the last incremental run (manifest) and items an earlier query already
+# harvested (seen) are skipped; found, if given, is the search's own seen-set, and results already
+# in it (from another partition) are left out entirely
+# Runs on a worker thread when pages are fetched concurrently
+def search_page_rows(page_url, seed, catalog_option, locgov_server, segments_option_choice, manifest=None, seen=None, query_hits=None, found=None):
+    search = locgov_search(page_url)
+    results = search['results']
+    page_hits = RowBuffer()
+    harvest_results = []
+    for result in results:
+        if found is not None and not found.add(result['id']):
+            continue
+        harvest = True
+        if manifest is not None:
+            harvest = manifest.check(result['id'], result_marker(result))
+        if harvest and seen is not None:
+            harvest = seen.add(result['id'])
+        if harvest:
+            harvest_results.append(result)
+        if query_hits is not None:
+            page_hits.writerow(query_hit_row(seed, result, harvest))
+    results = harvest_results
+    # In segments mode, start the resources requests of the next results on the page (as many
+    # as the client's prefetch threads) so they download while earlier results are being written
+    resources_futures = [None] * len(results)
+    prefetch_ahead = 0
+    if segments_option_choice == '2':
+        prefetch_ahead = get_client().prefetch_workers
+
+    def prefetch(i):
+        if i < len(results) and '/item/' in results[i]['id']:
+            resources_futures[i] = prefetch_item_resources(results[i]['id'].split('/')[-2], locgov_server, get_segment_stats().resource_stats)
+
+    for i in range(prefetch_ahead):
+        prefetch(i)
+    page_items = RowBuffer()
+    page_resources = RowBuffer()
+    for i, result in enumerate(results):
+        if prefetch_ahead:
+            prefetch(i + prefetch_ahead)
+        write_resource_rows(result, page_items, page_resources, catalog_option, locgov_server, segments_option_choice, resources_futures[i])
+        resources_futures[i] = None
+    return page_items, page_resources, page_hits
+
+def write_no_result_rows(seed, item_writer, resource_writer):
+    resultrow = {
+        'p1_item': seed,
+        'p1_resource' : 'NO RESULT FOR SEARCH'
+    }
+    item_writer.writerow(resultrow)
+    resource_writer.writerow(resultrow)
+    logger.info('%s', resultrow)
+
+# Finish a search once all its rows are written
+# complete is False when the run didn't see every result (it was resumed part way through)
+def finish_search(seed, item_writer, resource_writer, checkpoint, manifest, complete):
+    if manifest is not None:
+        write_removed_rows(manifest, item_writer, resource_writer, complete)
+    if checkpoint is not None:
+        checkpoint.query_done(seed)
+    # Saved once the query's rows are checkpointed, so a stopped run never skips unwritten items
+    if manifest is not None:
+        manifest.save(complete)
+
+# Columns of the query hits output: every item each query returned,
+# and whether it was harvested for that query or skipped
+QUERY_HITS_FIELDNAMES = ['query', 'p1_item_id', 'p1_item', 'harvested']
+
+def query_hit_row(seed, result, harvested):
+    return {
+        'query': seed,
+        'p1_item_id': result['id'].split('/')[-2],
+        'p1_item': result['id'],
+        'harvested': harvested,
+    }
+
+# Write a REMOVED row for each item the last run of a search returned but this one didn't
+def write_removed_rows(manifest, item_writer, resource_writer, complete):
+    removed = []
+    if complete:
+        removed = manifest.removed()
+    for item in removed:
         resultrow = {
-            'p1_item': seed,
-            'p1_resource' : 'NO RESULT FOR SEARCH'
+            'p1_item_id': item.split('/')[-2],
+            'p1_item': item,
+            'p1_resource': 'REMOVED'
         }
         item_writer.writerow(resultrow)
         resource_writer.writerow(resultrow)
-        print(resultrow)
-    else:
-        # Proceed with search for each page of results
-        while current_page <= total_pages:
-            #this_url = search_url + url_page + exclude
-            this_url = search_url + url_page + '&at=results'
-            search = locgov_search(this_url)
-            results = search['results']
-            for result in results:
-                write_resource_rows(result, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice)
-            current_page += 1
-            url_page = '&sp=' + str(current_page)
+    logger.info('Since the last run: %d new, %d changed, %d unchanged (skipped), %d removed',
+        manifest.new, manifest.changed, manifest.unchanged, len(removed))
 
 # Write the rows to the files for each search result
-def write_resource_rows(result, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice):
+# resources_future can be a prefetch_item_resources future already started for this item (segments mode only)
+def write_resource_rows(result, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, resources_future=None):
+    records = result_records(result, catalog_option, locgov_server, segments_option_choice, resources_future)
+    write_records(records, item_writer, resource_writer)
+
+# Write records from result_records to the item and resource writers
+def write_records(records, item_writer, resource_writer):
+    for record in records:
+        if isinstance(record, ResourceRecord):
+            resource_writer.writerow(record)
+        else:
+            item_writer.writerow(record)
+        logger.debug('%s', record)
+
+# Flatten one search result (or item) into typed records:
+# a ResourceRecord for each of its resources, then its ItemRecord
+# Yields nothing for results that aren't items, or for catalog records when they are excluded
+def result_records(result, catalog_option, locgov_server, segments_option_choice, resources_future=None):
     p1_item = result['id']
     p1_item_id = p1_item.split('/')[-2]
     # If not an item (such as a Framework page), skip
     if 'item' not in p1_item and 'lccn.loc.gov' not in p1_item:
-        print('Not an item: ', p1_item)
+        logger.debug('Not an item: %s', p1_item)
         return
     # If its a catalog record, skip based on decision
     if 'lccn.loc.gov' in p1_item and catalog_option == '2':
-        print('Skipping catalog item: ', p1_item)
+        logger.debug('Skipping catalog item: %s', p1_item)
         return
 
     # Pull all data out of the result JSON
@@ -114,7 +478,8 @@ def write_resource_rows(result, item_writer, resource_writer, catalog_option, lo
             p1_resources.append(resource)
     # print('p1 item: ', p1_item)
     # print('p1 resources: ', p1_resources)
-    resultrow = {
+    # Item-level columns, shared by the item's row and all of its resource rows
+    item_fields = {
         'p1_item_id': p1_item_id,
         'p1_item': p1_item,
         'digitized': digitized,
@@ -127,19 +492,25 @@ def write_resource_rows(result, item_writer, resource_writer, catalog_option, lo
         'group': group,
     }
     if len(p1_resources) == 0:
+        resultrow = ItemRecord(item_fields)
         resultrow.update({
             'p1_resource': 'NONE',
             'p1_resource_count': 0,
         })
-        item_writer.writerow(resultrow)
-        #resource_writer.writerow(resultrow)
-        print(resultrow)
+        yield resultrow
         return
 
+    # In segments mode the item's full resources are fetched once, each summed up into its
+    # segment statistics (locgovsegments) as it downloads
+    if segments_option_choice == '2':
+        segment_stats = get_segment_stats()
+        if resources_future is None:
+            resources_future = prefetch_item_resources(p1_item_id, locgov_server, get_segment_stats().resource_stats)
+        full_resources = resources_future.result()
+
     # For each of the resources, get data and write its own row
     short_resources = []
     for resource in p1_resources:
-        resourcerow = resultrow.copy()
         p1_resource = ''
         etl_aggregate = ''
         p1_resource_id = ''
@@ -166,224 +537,733 @@ def write_resource_rows(result, item_writer, resource_writer, catalog_option, lo
             'p1_resource_segment_count': p1_resource_segment_count,
         })
 
-        resourcerow.update({
-            'p1_resource': p1_resource,
-            'etl_aggregate': etl_aggregate,
-            'p1_resource_id': p1_resource_id,
-            'p1_resource_caption': p1_resource_caption,
-            'p1_resource_segment_count': p1_resource_segment_count,
-            'has_fulltext': has_fulltext
-        })
+        resourcerow = ResourceRecord(item_fields,
+            p1_resource=p1_resource,
+            etl_aggregate=etl_aggregate,
+            p1_resource_id=p1_resource_id,
+            p1_resource_caption=p1_resource_caption,
+            p1_resource_segment_count=p1_resource_segment_count,
+            has_fulltext=has_fulltext
+        )
         if 'representative_index' in resource:
-            resourcerow.update({
-                'representative_index': resource['representative_index']
-            })
+            resourcerow.representative_index = resource['representative_index']
 
         if segments_option_choice == '2':
             # Add more resource and segment data here
-            this_resource = None
-            p1_resource_segment_with_text = 0
+            this_resource_stats = None
             if p1_resource != '':
-                full_resources = locgov_item_resources(p1_item_id, locgov_server)
-                for full_resource in full_resources:
-                    if 'url' in full_resource and full_resource['url'] == p1_resource:
-                        this_resource = full_resource
-            if this_resource != None:
-                for f in this_resource['files']:
-                    for s in f:
-                        if 'use' in s and s['use'] == 'text':
-                            p1_resource_segment_with_text += 1
-            resourcerow.update({
-                'p1_resource_segment_with_text': p1_resource_segment_with_text,
-            })
-
-
-        resource_writer.writerow(resourcerow)
-        print(resourcerow)
+                this_resource_stats = full_resources.get(p1_resource)
+            if this_resource_stats is None:
+                this_resource_stats = segment_stats.resource_stats({})
+            for column, value in this_resource_stats.items():
+                setattr(resourcerow, column, value)
+
+        yield resourcerow
+    resultrow = ItemRecord(item_fields)
     resultrow.update({
         'p1_resource_count': len(short_resources),
         'p1_resource': short_resources
     })
-    item_writer.writerow(resultrow)
-    print(resultrow)
+    yield resultrow
+
+# Get a single item from the item list and build its rows
+# Any error is caught here and recorded as an ERROR row, so one bad item doesn't stop the rest of the list
+def harvest_item(item_id, catalog_option, locgov_server, segments_option_choice):
+    item_rows = RowBuffer()
+    resource_rows = RowBuffer()
+    try:
+        # In segments mode, get the item's resources at the same time as the item
+        resources_future = None
+        if segments_option_choice == '2':
+            resources_future = prefetch_item_resources(item_id, locgov_server, get_segment_stats().resource_stats)
+        item = locgov_item(item_id, locgov_server)
+        if item == 404:
+            resultrow = {
+                'p1_item': item_id,
+                'p1_resource': 'INVALID'
+            }
+            item_rows.writerow(resultrow)
+            resource_rows.writerow(resultrow)
+            logger.info('%s', resultrow)
+        else:
+            write_resource_rows(item, item_rows, resource_rows, catalog_option, locgov_server, segments_option_choice, resources_future)
+    except Exception as e:
+        logger.error('Error getting item %s: %r', item_id, e)
+        resultrow = {
+            'p1_item': item_id,
+            'p1_resource': 'ERROR'
+        }
+        # Drop any rows written before the error so the item isn't half in the output
+        item_rows = RowBuffer()
+        resource_rows = RowBuffer()
+        item_rows.writerow(resultrow)
+        resource_rows.writerow(resultrow)
+    return item_rows, resource_rows
+
+
+# Command line names for the menu choices in the prompts
+METHOD_ARGS = {'collection': '1', 'partof': '2', 'search': '3', 'items': '4', 'queries': '5'}
+YES_NO_ARGS = {'yes': '1', 'no': '2'}
+ORDER_ARGS = {'input': '1', 'finished': '2'}
+FORMAT_ARGS = {'csv': '1', 'jsonl': '2', 'parquet': '3'}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Pull Item and Resource lists from loc.gov JSON. '
+            'Any option not given is asked for at a prompt, unless --batch is set.')
+    parser.add_argument('--batch', action='store_true',
+        help='never prompt: use defaults for options not given, and stop if a required one is missing')
+    parser.add_argument('--method', choices=METHOD_ARGS,
+        help='collection, partof or search (with --value), or items or queries (with --input)')
+    parser.add_argument('--value', help='collection name, part of value or search query, as in the loc.gov URL')
+    parser.add_argument('--input',
+        help='CSV file with an item_id column (items) or a query column (queries), gzipped if it ends in .gz, or - for stdin')
+    parser.add_argument('--server', choices=['www', 'test', 'dev'], help='loc.gov server (default www)')
+    parser.add_argument('--segments', choices=YES_NO_ARGS, help='pull full resource segment data (default no)')
+    parser.add_argument('--segment-stats', metavar='STATS',
+        help='with --segments yes, file statistics to add as resource columns, comma separated or all: '
+            '%s (default text)' % ', '.join(STATS))
+    parser.add_argument('--catalog', choices=YES_NO_ARGS, help='include lccn.loc.gov items (default yes)')
+    parser.add_argument('--workers', type=int,
+        help='items or search pages to fetch at the same time (default 1); segments mode and --marcxml '
+            'each run as many requests again alongside them')
+    parser.add_argument('--order', choices=ORDER_ARGS,
+        help='row order for items with several workers: input list order or as finished (default input)')
+    parser.add_argument('--page-size', type=int, help='search results per page (default 100)')
+    parser.add_argument('--cache', help='response cache file, empty for none (default none)')
+    parser.add_argument('--format', choices=FORMAT_ARGS, help='output format (default csv)')
+    parser.add_argument('--output-dir', help='directory for the output files (default the current directory with --batch)')
+    parser.add_argument('--resume', metavar='CHECKPOINT', help='resume a stopped run from its checkpoint file')
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+        help='compress CSV and JSON Lines outputs as they are written: gzip, or zstd (needs zstandard); '
+            'compressed output cannot be resumed')
+    parser.add_argument('--rotate-rows', type=int, metavar='N',
+        help='split the outputs into numbered part files of N rows; rotated output cannot be resumed')
+    parser.add_argument('--rotate-size', type=float, metavar='MB',
+        help='split the outputs into numbered part files of about MB megabytes on disk')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+        help='DEBUG also logs every URL and row (default INFO)')
+    parser.add_argument('--progress-interval', type=float, default=30.0,
+        help='seconds between progress lines (default 30)')
+    parser.add_argument('--rate-limit', choices=['adaptive', 'off'], default='adaptive',
+        help='pace requests to loc.gov (default adaptive); off is only for servers you run yourself')
+    parser.add_argument('--archive', metavar='FILE',
+        help='record every loc.gov response to this WARC archive (such as run.warc.gz), with an index in FILE.idx')
+    parser.add_argument('--replay', metavar='FILE',
+        help='answer every request from a WARC archive made with --archive, with no network calls; '
+            'use the same options as the recorded run')
+    parser.add_argument('--base-url', help='send requests meant for loc.gov to this server, such as the locgovbench.py stand-in')
+    parser.add_argument('--incremental', metavar='DIR',
+        help='keep a manifest of each search in DIR and only write items that are new or changed since the last run, '
+            'with REMOVED rows for items that are gone')
+    parser.add_argument('--dedupe', choices=['exact', 'bloom', 'off'],
+        help='for queries, skip items an earlier query already harvested: exact, or bloom for '
+            'very large runs (a few new items may be skipped), or off (default exact)')
+    parser.add_argument('--bloom-capacity', type=int, default=DEFAULT_BLOOM_CAPACITY,
+        help='items expected with --dedupe bloom (default %d)' % DEFAULT_BLOOM_CAPACITY)
+    parser.add_argument('--partition', metavar='FACETS',
+        help='split searches deeper than --partition-pages pages into sub-searches by these facets, '
+            'comma separated such as dates,subject, and reconcile the items found with the search hits')
+    parser.add_argument('--partition-pages', type=int, default=DEFAULT_PARTITION_PAGES, metavar='N',
+        help='deepest search, in pages, before it is split with --partition (default %d)' % DEFAULT_PARTITION_PAGES)
+    parser.add_argument('--query-hits', action='store_true',
+        help='for queries, also write a file listing every item each query returned')
+    parser.add_argument('--marcxml', action='store_true',
+        help='also write the MARCXML catalog record of every item harvested to a gzipped MARC collection file')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+        help='harvest only shard I of N of the --input list (items or queries), such as 2/4 on the second of four machines')
+    parser.add_argument('--shards', type=int, metavar='N',
+        help='harvest the --input list in N processes at once and merge their outputs (needs --batch)')
+    parser.add_argument('--merge', nargs='+', metavar='FILE',
+        help='merge these shard outputs of one kind (items or resources) into --merge-output, then stop')
+    parser.add_argument('--merge-output', metavar='FILE', help='output file for --merge')
+    parser.add_argument('--metrics', metavar='FILE', help='write the request metrics to this file at the end of the run')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+        help='format of the --metrics file (default json)')
+    return parser.parse_args(argv)
+
+# Return a menu choice given on the command line, or ask for it at a prompt
+# With batch set nothing is asked and the default is used
+# With enter_default set, pressing Enter at the prompt also gives the default
+def choose_option(value, prompt, valid, default, batch, enter_default=False):
+    if value is not None:
+        return value
+    if batch:
+        return default
+    print(prompt)
+    choice = input()
+    if enter_default and choice == '':
+        return default
+    if choice not in valid:
+        print('Wrong input! : ', choice)
+        exit()
+    return choice
+
+# Return a number given on the command line, or ask for it at a prompt
+# Pressing Enter at the prompt, or leaving it out in batch mode, gives the default
+def choose_number(value, prompt, default, batch):
+    if value is None:
+        if batch:
+            return default
+        print(prompt)
+        value = input()
+        if value == '':
+            return default
+        if not value.isdigit():
+            print('Wrong input! : ', value)
+            exit()
+    if int(value) < 1:
+        print('Wrong input! : ', value)
+        exit()
+    return int(value)
+
+# --rotate-size in bytes, None if not given
+def rotate_size_bytes(args):
+    if not args.rotate_size:
+        return None
+    return int(args.rotate_size * 1024 * 1024)
+
+# --merge: merge shard outputs that were harvested separately, such as on several machines
+def merge_shards(args):
+    if args.merge_output is None:
+        sys.exit('--merge-output is needed with --merge')
+    output_format = args.format
+    if output_format is None:
+        output_format = output_format_of(args.merge_output)
+    if output_format is None:
+        sys.exit('--format is needed for --merge-output ' + args.merge_output)
+    try:
+        rows, duplicates = merge_outputs(args.merge, args.merge_output, output_format, args.rotate_rows, rotate_size_bytes(args))
+    except ValueError as e:
+        sys.exit(str(e))
+    logger.info('Merged %d rows into %s, dropped %d duplicate rows', rows, args.merge_output, duplicates)
+
+# --shards N: run a shard process with the same options for each shard, then merge their outputs
+# Shards write whole files and only the merged outputs are rotated
+# The shard outputs and their checkpoints are kept in a loc_gov_shards directory next to the
+# merged outputs, so a shard that stops can be resumed on its own and merged with --merge
+def run_shards(args):
+    if not args.batch or args.method not in ('items', 'queries') or args.input is None:
+        sys.exit('--shards needs --batch, --method items or queries, and --input')
+    if args.shard is not None or args.resume is not None:
+        sys.exit('--shards cannot be used with --shard or --resume')
+    if args.shards < 1:
+        sys.exit('--shards must be at least 1')
+    if args.input == '-':
+        sys.exit('--shards needs an --input file, each shard reads it')
+    output_dir = args.output_dir
+    if output_dir is None:
+        output_dir = os.getcwd()
+    output_format = args.format
+    if output_format is None:
+        output_format = 'csv'
+    shard_dir = getOutput(filename='loc_gov_shards', extension='', output_dir=output_dir)
+    os.makedirs(shard_dir)
+
+    shard_argv = ['--batch', '--method', args.method, '--input', args.input, '--output-dir', shard_dir,
+        '--format', output_format]
+    for option, value in [
+        ('--server', args.server), ('--segments', args.segments), ('--segment-stats', args.segment_stats),
+        ('--catalog', args.catalog),
+        ('--workers', args.workers), ('--order', args.order), ('--page-size', args.page_size),
+        ('--cache', args.cache), ('--log-level', args.log_level), ('--progress-interval', args.progress_interval),
+        ('--rate-limit', args.rate_limit), ('--base-url', args.base_url), ('--incremental', args.incremental),
+        ('--dedupe', args.dedupe), ('--bloom-capacity', args.bloom_capacity),
+        ('--metrics-format', args.metrics_format), ('--compress', args.compress),
+        ('--partition', args.partition), ('--partition-pages', args.partition_pages), ('--replay', args.replay),
+    ]:
+        if value is not None:
+            shard_argv += [option, str(value)]
+    if args.query_hits:
+        shard_argv.append('--query-hits')
+    if args.marcxml:
+        shard_argv.append('--marcxml')
+
+    processes = []
+    for index in range(1, args.shards + 1):
+        shard = (index, args.shards)
+        command = [sys.executable, os.path.abspath(__file__)] + shard_argv + ['--shard', '%d/%d' % shard]
+        if args.metrics:
+            metrics_path, extension = os.path.splitext(args.metrics)
+            command += ['--metrics', metrics_path + shard_suffix(shard) + extension]
+        if args.archive:
+            archive_path, extension = split_output_path(args.archive)
+            command += ['--archive', archive_path + shard_suffix(shard) + extension]
+        processes.append(subprocess.Popen(command))
+    logger.info('Started %d shard processes, writing to: %s', args.shards, shard_dir)
+    failed = [index for index, process in enumerate(processes, 1) if process.wait() != 0]
+    if failed:
+        sys.exit('Shards %s failed; resume them from their checkpoints in %s, then merge with --merge'
+            % (', '.join(str(index) for index in failed), shard_dir))
 
+    extension = OUTPUT_FORMATS[output_format]
+    if output_format != 'parquet':
+        extension += COMPRESSIONS.get(args.compress, '')
+    kinds = ['loc_gov_items', 'loc_gov_resources']
+    if args.query_hits:
+        kinds.append('loc_gov_query_hits')
+    for kind in kinds:
+        paths = []
+        for index in range(1, args.shards + 1):
+            prefix = 'OUTPUT-' + kind + shard_suffix((index, args.shards)) + '-'
+            for name in sorted(os.listdir(shard_dir)):
+                if name.startswith(prefix) and name.endswith(extension) and not name.endswith('-checkpoint.jsonl'):
+                    paths.append(os.path.join(shard_dir, name))
+        output_path = getOutput(filename=kind, extension=extension, output_dir=output_dir)
+        rows, duplicates = merge_outputs(paths, output_path, output_format, args.rotate_rows, rotate_size_bytes(args))
+        logger.info('Merged %d shards into %s: %d rows, dropped %d duplicate rows', len(paths), output_path, rows, duplicates)
 
-valid_methods = ['1', '2', '3', '4', '5']
-search_inputs = ['1', '2', '3']
-file_inputs = ['4', '5']
-print('This script will return lists of loc.gov Items and Resources based on your criteria')
-method_prompt = """
+def main(argv=None):
+    args = parse_args(argv)
+    batch = args.batch
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.merge:
+        merge_shards(args)
+        return
+    if args.shards:
+        run_shards(args)
+        return
+    if args.shard is not None and args.method not in (None, 'items', 'queries'):
+        sys.exit('--shard is only for --method items or queries')
+    if args.input == '-' and not batch:
+        sys.exit('--input - reads stdin, which the prompts need: use --batch')
+
+    valid_methods = ['1', '2', '3', '4', '5']
+    search_inputs = ['1', '2', '3']
+    file_inputs = ['4', '5']
+    print('This script will return lists of loc.gov Items and Resources based on your criteria')
+    method_prompt = """
 Enter number for methods to get Items/Resources:
     1. Enter loc.gov COLLECTION
     2. Enter loc.gov PART OF
     3. Enter loc.gov SEARCH QUERY
     4. Select list of loc.gov ITEMS
     5. Select list of loc.gov SEARCH QUERIES"""
-print(method_prompt)
-method_input = input()
-if method_input not in valid_methods:
-    print('Wrong input! : ', method_input)
+    if batch and args.method is None:
+        sys.exit('--method is needed with --batch')
+    method_input = choose_option(METHOD_ARGS.get(args.method), method_prompt, valid_methods, None, batch)
 
-if method_input == '1':
-    collection_prompt = """
+    if method_input in search_inputs and args.value is None and batch:
+        sys.exit('--value is needed for --method ' + args.method)
+    if method_input in file_inputs and args.input is None and batch:
+        sys.exit('--input is needed for --method ' + args.method)
+
+    if method_input == '1':
+        collection_prompt = """
     Enter loc.gov COLLECTION
         Input exactly as shown in loc.gov/collecton URL, including -'s
         Ex: https://www.loc.gov/collections/rare-book-selections/
         Enter: rare-book-selections"""
-    print(collection_prompt)
-    p1_collection = input()
+        p1_collection = args.value
+        if p1_collection is None:
+            print(collection_prompt)
+            p1_collection = input()
 
-if method_input == '2':
-    partof_prompt = """
+    if method_input == '2':
+        partof_prompt = """
     Enter loc.gov PART OF
         Input exactly as shown in loc.gov search URL, including +'s
         Ex: https://www.loc.gov/search/?fa=partof:world+digital+library
         Enter: world+digital+library"""
-    print(partof_prompt)
-    p1_partof = input()
+        p1_partof = args.value
+        if p1_partof is None:
+            print(partof_prompt)
+            p1_partof = input()
 
-if method_input == '3':
-    search_prompt = """
+    if method_input == '3':
+        search_prompt = """
     Enter loc.gov SEARCH QUERY
         Input exactly as shown in loc.gov search URL, including +'s
         Include quotes if required or if searching for exact identifier
         This will also search full text of items so you may get unexpected results for broad searches!
         Ex: https://www.loc.gov/search/?in=&q="france+in+america"
         Enter: "france+in+america" """
-    print(search_prompt)
-    p1_search = input()
-
-if method_input == '4':
-    print('Select CSV file with item_id list')
-    print('Should match expected data to follow loc.gov/item/....')
-    item_file = getInputFileGUI(prompt="Select CSV file with item list: ")
-    required_input_fieldnames = ['item_id']
-    item_list = []
-    with open(item_file, 'r', encoding='utf-8-sig') as item_file:
-        reader = csv.DictReader(item_file)
-        testRequiredInput(reader.fieldnames, required_input_fieldnames)
-        for row in reader:
-            item_list.append(row['item_id'])
-
-if method_input == '5':
-    print('Select CSV file with query list')
-    print('Likely use case is a list of identifiers that do not match to item or resource urls')
-    query_file = getInputFileGUI(prompt="Select CSV file with query list: ")
-    required_input_fieldnames = ['query']
-    query_list = []
-    with open(query_file, 'r', encoding='utf-8-sig') as query_file:
-        reader = csv.DictReader(query_file)
-        testRequiredInput(reader.fieldnames, required_input_fieldnames)
-        for row in reader:
-            query_list.append(row['query'])
-
-segments_option_valid = ['1', '2']
-segments_option_prompt = """
+        p1_search = args.value
+        if p1_search is None:
+            print(search_prompt)
+            p1_search = input()
+
+    if method_input == '4':
+        item_file = args.input
+        if item_file is None:
+            print('Select CSV file with item_id list')
+            print('Should match expected data to follow loc.gov/item/....')
+            item_file = getInputFileGUI(prompt="Select CSV file with item list: ")
+        # Read as the items are harvested, not loaded up front
+        item_list = read_input_column(item_file, 'item_id', args.shard)
+
+    if method_input == '5':
+        query_file = args.input
+        if query_file is None:
+            print('Select CSV file with query list')
+            print('Likely use case is a list of identifiers that do not match to item or resource urls')
+            query_file = getInputFileGUI(prompt="Select CSV file with query list: ")
+        query_list = read_input_column(query_file, 'query', args.shard)
+
+    segments_option_valid = ['1', '2']
+    segments_option_prompt = """
 Enter the number for whether to get full resource segment list.
 This will be much slower, but give more data. Use this for full text / transcription information.
     1. Do NOT pull segments data (FASTER)
     2. Pull segments data (SLOWER)"""
-print(segments_option_prompt)
-segments_option_choice = input()
-if segments_option_choice not in segments_option_valid:
-    print('Wrong input! : ', segments_option_choice)
-    exit()
-
-locgov_server_valid = ['1', '2', '3']
-locgov_server_prompt = """
+    # The menu is "1. do NOT pull", so the yes/no argument maps the other way round
+    segments_arg = {'yes': '2', 'no': '1'}.get(args.segments)
+    segments_option_choice = choose_option(segments_arg, segments_option_prompt, segments_option_valid, '1', batch)
+    if args.segment_stats:
+        try:
+            configure_segment_stats(parse_segment_stats(args.segment_stats))
+        except ValueError as e:
+            sys.exit(str(e))
+
+    locgov_server_valid = ['1', '2', '3']
+    locgov_server_prompt = """
 Enter number for methods to get Items/Resources:
     1. PRODUCTION (www.loc.gov)
     2. TEST (test.loc.gov)
     3. DEV (dev.loc.gov)"""
-print(locgov_server_prompt)
-locgov_server_choice = input()
-if locgov_server_choice not in locgov_server_valid:
-    print('Wrong input! : ', locgov_server_choice)
-    exit()
-
-if locgov_server_choice == '1':
-    locgov_server = 'www'
-if locgov_server_choice == '2':
-    locgov_server = 'test'
-if locgov_server_choice == '3':
-    locgov_server = 'dev'
-
-catalog_valid = ['1', '2']
-catalog_option_prompt = """
+    server_arg = {'www': '1', 'test': '2', 'dev': '3'}.get(args.server)
+    locgov_server_choice = choose_option(server_arg, locgov_server_prompt, locgov_server_valid, '1', batch)
+
+    if locgov_server_choice == '1':
+        locgov_server = 'www'
+    if locgov_server_choice == '2':
+        locgov_server = 'test'
+    if locgov_server_choice == '3':
+        locgov_server = 'dev'
+
+    catalog_valid = ['1', '2']
+    catalog_option_prompt = """
 Enter number for whether to include lccn.loc.gov item
     You may want to include this to find un-ETLed items that redirect to the Catalog
     Probably don't include if you know you have a lot of expected un-ETLed items
     Include lccn.loc.gov items?
     1. YES
     2. NO"""
-print(catalog_option_prompt)
-catalog_option = input()
-if catalog_option not in catalog_valid:
-    print('Wrong input! : ', catalog_option)
-
-
-print('Select output location for ITEMS list')
-item_output = getOutput(filename='loc_gov_items')
-item_output_fieldnames = ['p1_item_id', 'p1_item', 'p1_resource_count', 'p1_resource', 'digitized',
-    'number_lccn', 'number_fileID', 'number_uuid',
-    'online_format', 'mime_type', 'partof', 'group',
-]
-
-print('Select output location for RESOURCES list')
-resource_output = getOutput(filename='loc_gov_resources')
-resource_output_fieldnames = ['p1_item_id', 'p1_item', 'p1_resource', 'etl_aggregate', 'p1_resource_id',
-    'p1_resource_caption', 'p1_resource_segment_count', 'digitized',
-    'number_lccn', 'number_fileID', 'number_uuid',
-    'online_format', 'mime_type', 'partof', 'group',
-    'has_fulltext', 'representative_index',
-]
-
-if segments_option_choice == '2':
-    resource_output_fieldnames.append(
-        'p1_resource_segment_with_text'
-    )
-
-with open (item_output, 'w', encoding='utf-8-sig') as item_output:
-    item_writer = csv.DictWriter(item_output, fieldnames=item_output_fieldnames, lineterminator='\n')
-    item_writer.writeheader()
-
-    with open (resource_output, 'w', encoding='utf-8-sig') as resource_output:
-        resource_writer = csv.DictWriter(resource_output, fieldnames=resource_output_fieldnames, lineterminator='\n')
-        resource_writer.writeheader()
-
-        # Build the search seed URL based on input
+    catalog_option = choose_option(YES_NO_ARGS.get(args.catalog), catalog_option_prompt, catalog_valid, '1', batch)
+
+    workers_prompt = """
+Enter number of items or search pages to fetch at the same time, or press Enter for 1
+    Higher numbers finish large collections faster but put more load on the server
+    Segments mode runs as many resources requests again alongside them"""
+    workers = choose_number(args.workers, workers_prompt, 1, batch)
+
+    page_size = 10
+    if method_input != '4':
+        page_size_prompt = """
+Enter number of search results to get per page, or press Enter for 100
+    Bigger pages mean fewer requests for the same results"""
+        page_size = choose_number(args.page_size, page_size_prompt, 100, batch)
+
+    cache_prompt = """
+Enter a file path for a response cache to reuse loc.gov data between runs, or press Enter for no cache
+    Re-running with the same cache file only requests what is new or expired
+    Ex: locgov_cache.sqlite"""
+    cache_path = args.cache
+    if cache_path is None and not batch:
+        print(cache_prompt)
+        cache_path = input()
+    response_cache = None
+    if cache_path:
+        response_cache = ResponseCache(cache_path)
+    # Requests are paced by a rate limiter that backs off when loc.gov throttles or slows down
+    rate_limiter = None
+    if args.rate_limit == 'adaptive' and args.replay is None:
+        rate_limiter = AdaptiveRateLimiter()
+    # A replayed response is the same every time, so it is never retried
+    archive = None
+    replay = None
+    retry_policy = None
+    if args.archive:
+        archive = ResponseArchive(args.archive)
+        logger.info('Recording responses to: %s', args.archive)
+    if args.replay:
+        try:
+            replay = ResponseArchive(args.replay, replay=True)
+        except FileNotFoundError as e:
+            sys.exit(str(e))
+        retry_policy = RetryPolicy(max_attempts=1)
+        logger.info('Replaying responses from: %s', args.replay)
+    # Every thread that can be fetching at once needs a pooled connection, or the pool
+    # throws keep-alive connections away: the item or page workers, the resources
+    # prefetches in segments mode, and the MARCXML pipeline
+    pool_size = workers
+    if segments_option_choice == '2':
+        pool_size += workers
+    if args.marcxml:
+        pool_size += workers
+    # --base-url sends the requests to a stand-in server, as locgovbench.py does
+    configure_client(pool_size=max(pool_size, DEFAULT_POOL_SIZE), cache=response_cache, rate_limiter=rate_limiter,
+        base_url=args.base_url, retry_policy=retry_policy, archive=archive, replay=replay, prefetch_workers=workers)
+
+    dedupe = 'off'
+    if method_input == '5':
+        dedupe_valid = ['1', '2', '3']
+        dedupe_prompt = """
+Enter number for items found by more than one query, or press Enter for 1
+    1. Harvest each item once, for the first query that finds it (FASTER)
+    2. Same, using less memory for very large runs (a few items may be missed)
+    3. Harvest the item again for every query"""
+        dedupe_arg = {'exact': '1', 'bloom': '2', 'off': '3'}.get(args.dedupe)
+        dedupe_choice = choose_option(dedupe_arg, dedupe_prompt, dedupe_valid, '1', batch, enter_default=True)
+        dedupe = ['exact', 'bloom', 'off'][int(dedupe_choice) - 1]
+
+    # Facet partitions can overlap, so partitioned searches keep a seen-set as well, which
+    # also stops a resumed run writing an item again that an earlier partition wrote
+    partition_facets = None
+    if args.partition and method_input != '4':
+        partition_facets = [facet.strip() for facet in args.partition.split(',') if facet.strip()]
         if method_input in search_inputs:
-            if method_input == '1':
-                url_start = 'https://%s.loc.gov/collections/' % locgov_server
-                search_url = url_start + p1_collection + '/?'
-            if method_input == '2':
-                url_start = 'https://%s.loc.gov/search/?fa=partof:' % locgov_server
-                search_url = url_start + p1_partof
-            if method_input == '3':
-                url_start = 'https://%s.loc.gov/search/?q=' % locgov_server
-                search_url = url_start + p1_search
-
-            paged_search(search_url, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice)
-
-        # Get each item individually for item CSV
-        if method_input == '4':
-            for i in item_list:
-                item = locgov_item(i, locgov_server)
-                if item == 404:
-                    resultrow = {
-                        'p1_item': i,
-                        'p1_resource': 'INVALID'
-                    }
-                    item_writer.writerow(resultrow)
-                    resource_writer.writerow(resultrow)
-                    print(resultrow)
+            dedupe = args.dedupe or 'exact'
+        # A resumed run can only skip the items the stopped one wrote with a seen-set
+        if dedupe == 'off':
+            sys.exit('--partition needs --dedupe exact or bloom, so a resumed run doesn\'t write items twice')
+
+    item_order = '1'
+    if method_input == '4' and workers > 1:
+        item_order_valid = ['1', '2']
+        item_order_prompt = """
+Enter number for the order of rows in the output files, or press Enter for 1
+    1. Same order as the item list
+    2. As soon as each item is finished (FASTER)"""
+        item_order = choose_option(ORDER_ARGS.get(args.order), item_order_prompt, item_order_valid, '1', batch, enter_default=True)
+
+
+    item_output_fieldnames = ['p1_item_id', 'p1_item', 'p1_resource_count', 'p1_resource', 'digitized',
+        'number_lccn', 'number_fileID', 'number_uuid',
+        'online_format', 'mime_type', 'partof', 'group',
+    ]
+
+    resource_output_fieldnames = ['p1_item_id', 'p1_item', 'p1_resource', 'etl_aggregate', 'p1_resource_id',
+        'p1_resource_caption', 'p1_resource_segment_count', 'digitized',
+        'number_lccn', 'number_fileID', 'number_uuid',
+        'online_format', 'mime_type', 'partof', 'group',
+        'has_fulltext', 'representative_index',
+    ]
+
+    if segments_option_choice == '2':
+        resource_output_fieldnames += get_segment_stats().columns
+
+    output_format_valid = ['1', '2', '3']
+    output_format_prompt = """
+Enter number for the format of the ITEMS and RESOURCES files, or press Enter for CSV
+    1. CSV
+    2. JSON Lines (one JSON object per row, list fields kept as lists)
+    3. Parquet (columnar, list fields kept as lists, needs pyarrow)"""
+    output_format_choice = choose_option(FORMAT_ARGS.get(args.format), output_format_prompt, output_format_valid, '1', batch, enter_default=True)
+    output_format = ['csv', 'jsonl', 'parquet'][int(output_format_choice) - 1]
+    if output_format == 'parquet' and pyarrow is None:
+        print('Parquet output needs the pyarrow package installed')
+        exit()
+
+    # Parquet is always compressed inside the file
+    compression = args.compress
+    if output_format == 'parquet' and compression is not None:
+        logger.warning('Parquet output is already compressed, ignoring --compress')
+        compression = None
+    if compression == 'zstd' and zstandard is None:
+        print('zstd compression needs the zstandard package installed')
+        exit()
+    output_extension = OUTPUT_FORMATS[output_format] + COMPRESSIONS.get(compression, '')
+    rotate_bytes = rotate_size_bytes(args)
+    rotate = bool(args.rotate_rows or rotate_bytes)
+
+    # Only ask loc.gov for the result fields these columns are built from
+    search_projection = results_projection(item_output_fieldnames + resource_output_fieldnames)
+
+    # Options that must match when a stopped run is resumed
+    run_settings = {
+        'method': method_input,
+        'segments': segments_option_choice,
+        'server': locgov_server,
+        'catalog': catalog_option,
+        'page_size': page_size,
+        'output_format': output_format,
+    }
+    if args.incremental is not None:
+        run_settings['incremental'] = args.incremental
+    if segments_option_choice == '2' and get_segment_stats().stats != DEFAULT_STATS:
+        run_settings['segment_stats'] = get_segment_stats().stats
+    if partition_facets is not None:
+        run_settings['partition'] = [partition_facets, args.partition_pages]
+    if compression is not None:
+        run_settings['compression'] = compression
+    if rotate:
+        run_settings['rotate'] = [args.rotate_rows, rotate_bytes]
+    output_suffix = ''
+    if args.shard is not None:
+        run_settings['shard'] = list(args.shard)
+        output_suffix = shard_suffix(args.shard)
+
+    resume_valid = ['1', '2']
+    resume_prompt = """
+Enter number for whether to start a new run or resume a stopped one, or press Enter for a NEW run
+    1. NEW run
+    2. RESUME a stopped run from its checkpoint file
+       Choose the same options and input file as the stopped run"""
+    resume_arg = None
+    if args.resume is not None:
+        resume_arg = '2'
+    resume_choice = choose_option(resume_arg, resume_prompt, resume_valid, '1', batch, enter_default=True)
+
+    if resume_choice == '2' and output_format == 'parquet':
+        print('Parquet output cannot be resumed, start a new run')
+        exit()
+    # A compressed file can't be cut back to the last checkpoint, nor can a set of parts
+    if resume_choice == '2' and (compression is not None or rotate):
+        print('Compressed or rotated output cannot be resumed, start a new run')
+        exit()
+
+    if resume_choice == '2':
+        checkpoint_file = args.resume
+        if checkpoint_file is None:
+            checkpoint_file = getInputFileGUI(prompt="Select checkpoint file: ")
+        checkpoint = resume_checkpoint(checkpoint_file)
+        if checkpoint.settings != run_settings:
+            print('Checkpoint was made with different options: ', checkpoint.settings)
+            exit()
+        item_output = checkpoint.item_output
+        resource_output = checkpoint.resource_output
+        print('Resuming into: ', item_output, resource_output)
+    else:
+        output_dir = args.output_dir
+        if output_dir is None and batch:
+            output_dir = os.getcwd()
+        if output_dir is None:
+            print('Select output location for ITEMS list')
+        item_output = getOutput(filename='loc_gov_items' + output_suffix, extension=output_extension, output_dir=output_dir)
+        if output_dir is None:
+            print('Select output location for RESOURCES list')
+        resource_output = getOutput(filename='loc_gov_resources' + output_suffix, extension=output_extension, output_dir=output_dir)
+        if output_format == 'parquet' or compression is not None or rotate:
+            checkpoint = untracked_checkpoint(run_settings, item_output, resource_output)
+        else:
+            checkpoint_file = split_output_path(item_output)[0] + '-checkpoint.jsonl'
+            checkpoint = start_checkpoint(checkpoint_file, run_settings, item_output, resource_output)
+            print('Checkpoint file, use this to resume if the run stops: ', checkpoint_file)
+
+    # A resumed run appends after the rows kept by the checkpoint
+    output_mode = 'w'
+    if checkpoint.item_bytes > 0:
+        output_mode = 'a'
+
+    # Items already written by a resumed run count as seen
+    seen = make_seen_items(dedupe, args.bloom_capacity)
+    if seen is not None and output_mode == 'a':
+        for row in read_output(item_output, output_format):
+            if row.get('p1_item'):
+                seen.add(row['p1_item'])
+
+    query_hits = None
+    if method_input == '5' and args.query_hits:
+        query_hits_output = getOutput(filename='loc_gov_query_hits' + output_suffix, extension=output_extension,
+            output_dir=os.path.dirname(item_output))
+        query_hits_file = open_output(query_hits_output, output_format, compression=compression)
+        query_hits = make_writer(output_format, query_hits_file, QUERY_HITS_FIELDNAMES)
+        query_hits.writeheader()
+        print('Query hits file: ', query_hits_output)
+
+    # MARCXML records are fetched alongside the harvest, as each item row is written
+    # A resumed run writes a new collection file with the records of the items it harvests
+    marcxml_pipeline = None
+    if args.marcxml:
+        marcxml_output = getOutput(filename='loc_gov_marcxml' + output_suffix, extension='.xml.gz',
+            output_dir=os.path.dirname(item_output))
+        marcxml_pipeline = MarcxmlPipeline(marcxml_output, workers, locgov_server)
+        print('MARCXML file: ', marcxml_output)
+
+    progress = Progress(args.progress_interval)
+    with open_output(item_output, output_format, output_mode, compression, args.rotate_rows, rotate_bytes) as item_output:
+        # The item p1_resource column holds the list of resource summaries
+        item_writer = make_writer(output_format, item_output, item_output_fieldnames, nested_columns=['p1_resource'])
+        item_writer = progress.track(item_writer, 'items')
+        if marcxml_pipeline is not None:
+            item_writer = MarcxmlTap(item_writer, marcxml_pipeline)
+
+        with open_output(resource_output, output_format, output_mode, compression, args.rotate_rows, rotate_bytes) as resource_output:
+            resource_writer = make_writer(output_format, resource_output, resource_output_fieldnames)
+            resource_writer = progress.track(resource_writer, 'resources')
+            checkpoint.attach(item_output, resource_output)
+            if output_mode == 'w':
+                item_writer.writeheader()
+                resource_writer.writeheader()
+                checkpoint.commit()
+
+            # Build the search seed URL based on input
+            if method_input in search_inputs:
+                if method_input == '1':
+                    url_start = 'https://%s.loc.gov/collections/' % locgov_server
+                    search_url = url_start + p1_collection + '/?'
+                if method_input == '2':
+                    url_start = 'https://%s.loc.gov/search/?fa=partof:' % locgov_server
+                    search_url = url_start + p1_partof
+                if method_input == '3':
+                    url_start = 'https://%s.loc.gov/search/?q=' % locgov_server
+                    search_url = url_start + p1_search
+
+                if partition_facets is not None:
+                    partitioned_search(search_url, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, partition_facets, args.partition_pages,
+                        workers, checkpoint, page_size, search_projection, args.incremental, seen)
                 else:
-                    write_resource_rows(item, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice)
-
-        # Perform each search individually for search CSV
-        if method_input == '5':
-            for i in query_list:
-                url_start = 'https://%s.loc.gov/search/?q=' % locgov_server
-                i = i.replace(' ', '+')
-                search_url = url_start + '"' + i + '"'
-                paged_search(search_url, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice)
+                    paged_search(search_url, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, workers, checkpoint, page_size, search_projection, args.incremental,
+                        seen)
+
+            # Get each item individually for item CSV
+            # Items are fetched up to workers at a time, written in list order unless item_order is '2'
+            if method_input == '4':
+                # Items finished before a resumed run stopped are skipped
+                def fetch_item(i):
+                    item_rows, resource_rows = harvest_item(i, catalog_option, locgov_server, segments_option_choice)
+                    return i, item_rows, resource_rows
+                item_todo = (i for i in item_list if not checkpoint.item_is_done(i))
+                for i, item_rows, resource_rows in bounded_map(fetch_item, item_todo, workers, item_order == '1'):
+                    item_rows.write_to(item_writer)
+                    resource_rows.write_to(resource_writer)
+                    checkpoint.item_done(i)
+                checkpoint.commit()
+
+            # Perform each search individually for search CSV
+            if method_input == '5':
+                for i in query_list:
+                    url_start = 'https://%s.loc.gov/search/?q=' % locgov_server
+                    i = i.replace(' ', '+')
+                    search_url = url_start + '"' + i + '"'
+                    if partition_facets is not None:
+                        partitioned_search(search_url, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, partition_facets, args.partition_pages,
+                            workers, checkpoint, page_size, search_projection, args.incremental, seen, query_hits)
+                    else:
+                        paged_search(search_url, item_writer, resource_writer, catalog_option, locgov_server, segments_option_choice, workers, checkpoint, page_size, search_projection, args.incremental,
+                            seen, query_hits)
+                if seen is not None:
+                    logger.info('Distinct items harvested across queries: %d', len(seen))
+
+            item_writer.close()
+            resource_writer.close()
+
+    if rotate:
+        logger.info('Wrote %d item part files and %d resource part files', len(item_output.paths), len(resource_output.paths))
+    if query_hits is not None:
+        query_hits.close()
+        query_hits_file.close()
+    if marcxml_pipeline is not None:
+        logger.info('MARCXML: %s', marcxml_pipeline.close())
+
+    progress.log()
+    if response_cache is not None:
+        logger.info('Response cache: %s', response_cache.stats())
+    if rate_limiter is not None:
+        logger.info('Final request rates per server: %s', rate_limiter.rates())
+    if archive is not None:
+        logger.info('Response archive: %s', archive.stats())
+    if replay is not None:
+        logger.info('Replayed responses: %s', replay.stats())
+    metrics = get_client().metrics
+    logger.info('Requests:\n%s', format_report(metrics.summary()))
+    if args.metrics:
+        metrics.export(args.metrics, args.metrics_format)
+        logger.info('Request metrics written to: %s', args.metrics)
+    checkpoint.close()
+
+
+if __name__ == '__main__':
+    main()
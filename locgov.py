@@ -6,47 +6,465 @@ import json
 import time
 import os
 import sys
+import random
+import threading
+import email.utils
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+from locgovmetrics import FetchMetrics, endpoint_type
+
+# Optional faster JSON parsers
+# orjson parses whole documents from bytes; ijson parses incrementally as a response downloads
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Defaults for the shared client
+# Every request asks for compressed JSON; (connect, read) timeout in seconds
+DEFAULT_HEADERS = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, deflate',
+    'User-Agent': 'loc-gov-json',
+}
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_POOL_SIZE = 10
+
+logger = logging.getLogger('locgov')
+
+# Raised when a URL can't be fetched: a permanent error such as a 403,
+# or a transient one that kept happening until the retry policy gave up
+class LocGovFetchError(Exception):
+    def __init__(self, url, reason):
+        super().__init__('%s: %s' % (url, reason))
+        self.url = url
+        self.reason = reason
+
+# Raised inside a fetch for failures worth retrying: connection errors, timeouts,
+# 429/5xx responses and error pages served in place of JSON
+# retry_after is the server's Retry-After in seconds, if it sent one
+class RetryableError(Exception):
+    def __init__(self, reason, retry_after=None):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+# Seconds to wait from a Retry-After header, which is either seconds or an HTTP date
+# Returns None if the header is missing or can't be read
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+# How failed requests are retried: exponential backoff with full jitter,
+# stopping after max_attempts tries or once deadline seconds have passed
+# A server's Retry-After is always waited out in full
+class RetryPolicy:
+    def __init__(self, max_attempts=8, base_delay=0.5, max_delay=60.0, deadline=600.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    # Seconds to wait after failed attempt number `attempt` (1 for the first)
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    # Call fetch_once until it returns, retrying when it raises RetryableError
+    # Raises LocGovFetchError once attempts or time run out
+    def call(self, url, fetch_once):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fetch_once()
+            except RetryableError as e:
+                delay = self.backoff(attempt, e.retry_after)
+                if attempt >= self.max_attempts or time.monotonic() - start + delay > self.deadline:
+                    raise LocGovFetchError(url, 'gave up after %d attempts, last error: %s' % (attempt, e))
+                logger.warning('%s, retrying in %.1f seconds: %s', e, delay, url)
+                time.sleep(delay)
+
+# Client-side rate limit shared by every request through the client, kept separately per host
+# Each host has a token bucket whose rate adapts AIMD-style: it climbs by about `increase`
+# requests/second for every second of clean responses, and is cut by the `decrease` factor
+# (at most once per second) when requests are throttled or fail with a retryable error,
+# or when responses take longer than latency_target seconds
+class AdaptiveRateLimiter:
+    def __init__(self, initial_rate=5.0, min_rate=0.5, max_rate=50.0, increase=1.0, decrease=0.5, latency_target=10.0):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    # Bucket state for a URL's host, created at the initial rate
+    # Caller must hold the lock
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = {
+                'rate': self.initial_rate,
+                'tokens': 1.0,
+                'updated': time.monotonic(),
+                'last_decrease': 0.0,
+            }
+        return self.buckets[host]
+
+    # Wait until a request to this URL's host is allowed
+    def acquire(self, url):
+        while True:
+            with self.lock:
+                bucket = self._bucket(url)
+                now = time.monotonic()
+                burst = max(1.0, bucket['rate'])
+                bucket['tokens'] = min(burst, bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+                bucket['updated'] = now
+                if bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    return
+                wait = (1 - bucket['tokens']) / bucket['rate']
+            time.sleep(wait)
+
+    # Adjust the host's rate from the outcome of a request
+    def record(self, url, throttled, latency):
+        with self.lock:
+            bucket = self._bucket(url)
+            now = time.monotonic()
+            if throttled or latency > self.latency_target:
+                if now - bucket['last_decrease'] >= 1.0:
+                    bucket['rate'] = max(self.min_rate, bucket['rate'] * self.decrease)
+                    bucket['last_decrease'] = now
+            else:
+                bucket['rate'] = min(self.max_rate, bucket['rate'] + self.increase / bucket['rate'])
+
+    # Current requests/second for each host, for the end of run summary
+    def rates(self):
+        with self.lock:
+            return {host: round(bucket['rate'], 2) for host, bucket in self.buckets.items()}
+
+# HTTP client shared by every loc.gov fetch
+# Holds a keep-alive connection pool per host (www/test/dev.loc.gov) so only the
+# first call to each server pays for the TCP+TLS handshake
+# cache is an optional locgovcache.ResponseCache used by get_locgov_json and locgov_search
+# retry_policy is the RetryPolicy for fetch(), the defaults if not given
+# rate_limiter is an optional AdaptiveRateLimiter that paces every fetch() attempt
+# metrics is the locgovmetrics.FetchMetrics every request is recorded in, a new one if not given
+# base_url, if given, is a server that gets every request meant for a loc.gov host instead
+# Ex: base_url='http://127.0.0.1:8000' for the stand-in server in locgovbench.py
+# archive is an optional locgovarchive.ResponseArchive every response is recorded in
+# replay is an optional locgovarchive.ResponseArchive every request is answered from, with no network calls
+# prefetch_workers is how many background requests (segments mode resources) run at the same time
+class LocGovClient:
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, headers=None, cache=None, retry_policy=None, rate_limiter=None, metrics=None, base_url=None,
+            archive=None, replay=None, prefetch_workers=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_executor = None
+        self.prefetch_lock = threading.Lock()
+        self.timeout = timeout
+        self.base_url = base_url
+        self.archive = archive
+        self.replay = replay
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        if self.retry_policy is None:
+            self.retry_policy = RetryPolicy()
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = FetchMetrics()
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        if headers is not None:
+            self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # GET a URL through the pool, using the default timeout unless one is given
+    # With stream=True the body is left unread for incremental parsing
+    # The request is recorded in the metrics under its endpoint type, worked out from the URL if not given;
+    # a streamed body isn't read yet, so its size is taken from Content-Length
+    # Responses are archived and replayed under the URL asked for, before any base_url
+    # A recorded streamed response is read whole, so it can be archived, then parsed from memory
+    def get(self, url, headers=None, timeout=None, stream=False, endpoint=None):
+        if timeout is None:
+            timeout = self.timeout
+        if endpoint is None:
+            endpoint = endpoint_type(url)
+        start = time.monotonic()
+        if self.replay is not None:
+            response = self.replay.response(url)
+            if response is None:
+                raise LocGovFetchError(url, 'not in the replay archive')
+            self.metrics.record_request(endpoint, time.monotonic() - start, response.status_code, len(response.content))
+            return response
+        archive_url = url
+        if self.base_url is not None:
+            url = rebase_url(url, self.base_url)
+        try:
+            response = self.session.get(url, headers=headers, timeout=timeout, stream=stream)
+        except requests.RequestException as e:
+            self.metrics.record_request(endpoint, time.monotonic() - start, type(e).__name__, 0)
+            raise
+        if stream:
+            size = int(response.headers.get('Content-Length') or 0)
+        else:
+            # Bytes as received, before gzip decoding
+            size = response.raw.tell() or len(response.content)
+        self.metrics.record_request(endpoint, time.monotonic() - start, response.status_code, size)
+        if self.archive is not None:
+            response = self.archive.record(archive_url, response)
+        return response
+
+    # GET a URL, retrying connection errors, timeouts, 429 and 5xx responses under the retry policy
+    # Returns the response for successes and 404s; other 4xx responses are permanent and raise LocGovFetchError
+    # parse, if given, is called on the response and its result returned instead;
+    # it can raise RetryableError to have a bad body retried
+    # stream=True returns as soon as the headers arrive; the caller reads and closes the body
+    # endpoint is the endpoint type the requests are recorded under in the metrics
+    def fetch(self, url, headers=None, parse=None, stream=False, endpoint=None):
+        if endpoint is None:
+            endpoint = endpoint_type(url)
+        attempts = [0]
+        def fetch_once():
+            attempts[0] += 1
+            if self.rate_limiter is None:
+                return self._fetch_once(url, headers, parse, stream, endpoint)
+            self.rate_limiter.acquire(url)
+            start = time.monotonic()
+            try:
+                result = self._fetch_once(url, headers, parse, stream, endpoint)
+            except RetryableError:
+                self.rate_limiter.record(url, True, time.monotonic() - start)
+                raise
+            self.rate_limiter.record(url, False, time.monotonic() - start)
+            return result
+        try:
+            result = self.retry_policy.call(url, fetch_once)
+        except LocGovFetchError:
+            self.metrics.record_fetch(endpoint, attempts[0], failed=True)
+            raise
+        self.metrics.record_fetch(endpoint, attempts[0])
+        return result
+
+    # One attempt of fetch()
+    def _fetch_once(self, url, headers, parse, stream, endpoint):
+        try:
+            response = self.get(url, headers=headers, stream=stream, endpoint=endpoint)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            raise RetryableError(type(e).__name__)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.close()
+            raise RetryableError('HTTP %d' % response.status_code, retry_after_seconds(response))
+        if response.status_code >= 400 and response.status_code != 404:
+            response.close()
+            raise LocGovFetchError(url, 'HTTP %d' % response.status_code)
+        if parse is None:
+            return response
+        return parse(response)
+
+    # Run func(*args) in the background on the client's prefetch threads, returning its future
+    def prefetch(self, func, *args):
+        with self.prefetch_lock:
+            if self.prefetch_executor is None:
+                self.prefetch_executor = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+        return self.prefetch_executor.submit(func, *args)
+
+    def close(self):
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown(wait=False)
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.replay is not None:
+            self.replay.close()
+
+# Point a loc.gov URL at another server, keeping its path and query
+# URLs for other hosts are returned unchanged
+def rebase_url(url, base_url):
+    parts = urlsplit(url)
+    if not parts.netloc.endswith('loc.gov'):
+        return url
+    base = urlsplit(base_url)
+    return urlunsplit((base.scheme, base.netloc, base.path.rstrip('/') + parts.path, parts.query, parts.fragment))
+
+_client = None
+_client_lock = threading.Lock()
+
+# Return the shared client, creating it with the defaults on first use
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LocGovClient()
+        return _client
+
+# Replace the shared client, e.g. to raise the pool size for concurrent harvests
+# Takes the same arguments as LocGovClient
+def configure_client(**kwargs):
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = LocGovClient(**kwargs)
+        return _client
+
+# Parse JSON straight from the response bytes, skipping the decode to str
+# Uses orjson when it's installed
+def loads_json(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+# Return the cached JSON for a URL, or None if there is no cache or the URL isn't in it
+# A response served from the cache is still recorded in the client's archive, if it has one
+def _cached_json(url):
+    client = get_client()
+    cache = client.cache
+    if cache is None:
+        return None
+    cached = cache.get(url)
+    if cached is None:
+        return None
+    client.metrics.record_cache_hit(endpoint_type(url))
+    if client.archive is not None:
+        client.archive.put(url, cached[0], 'application/json', cached[1])
+    return loads_json(cached[1])
+
+# Save a fetched response in the cache, if there is one
+# A JSON body with status 404 is saved as a 404 so it can be negative-cached
+def _cache_json(url, content, loc_json):
+    cache = get_client().cache
+    if cache is None:
+        return
+    status = 200
+    if 'status' in loc_json and loc_json['status'] == 404:
+        status = 404
+    cache.put(url, status, content)
+
+# Read the JSON from a loc.gov response, returning (body bytes, JSON)
+# loc.gov serves HTML error and throttling pages in place of JSON, so those are retried
+# A 404 without a JSON body is given loc.gov's own 404 JSON
+def _parse_json(response):
+    try:
+        return response.content, loads_json(response.content)
+    except ValueError:
+        if response.status_code == 404:
+            return b'{"status": 404}', {'status': 404}
+        raise RetryableError('Response was not JSON')
+
+# Get the JSON for a loc.gov URL, from the cache if there is one
+# Failed requests are retried under the shared client's retry policy
+# Raises LocGovFetchError if the URL can't be fetched
+def fetch_json(url):
+    loc_json = _cached_json(url)
+    if loc_json is not None:
+        return loc_json
+    content, loc_json = get_client().fetch(url, parse=_parse_json)
+    _cache_json(url, content, loc_json)
+    return loc_json
+
+# A response body read through to the parser, keeping a copy of what was read for the cache
+class _CopyingReader:
+    def __init__(self, raw):
+        self.raw = raw
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.chunks.append(data)
+        return data
+
+    # The whole body, reading whatever the parser left unread
+    def content(self):
+        while self.read(65536):
+            pass
+        return b''.join(self.chunks)
+
+# Yield the entries of one top-level list in a loc.gov JSON response ('results' or 'resources')
+# one at a time, parsing the body as it downloads instead of holding the whole document
+# With a cache, the body is copied as it is parsed and cached once every entry has been read,
+# and a cached copy is used if there is one
+# Without the optional ijson package the document is parsed whole and its entries yielded
+# Yields nothing for a 404
+def iter_json_list(url, list_name):
+    if ijson is None:
+        yield from _json_list(fetch_json(url), list_name)
+        return
+    loc_json = _cached_json(url)
+    if loc_json is not None:
+        yield from _json_list(loc_json, list_name)
+        return
+    cache = get_client().cache
+    response = get_client().fetch(url, stream=True)
+    yielded = False
+    try:
+        if response.status_code == 404:
+            if cache is not None:
+                cache.put(url, 404, b'{"status": 404}')
+            return
+        response.raw.decode_content = True
+        body = response.raw
+        if cache is not None:
+            body = _CopyingReader(response.raw)
+        for entry in ijson.items(body, list_name + '.item', use_float=True):
+            yielded = True
+            yield entry
+        if cache is not None:
+            cache.put(url, 200, body.content())
+    except Exception:
+        if yielded:
+            raise
+        # Not JSON (an error page) or cut off before the first entry:
+        # get the whole document instead, which is retried under the retry policy
+        yield from _json_list(fetch_json(url), list_name)
+    finally:
+        response.close()
+
+# Entries of a top-level list in parsed loc.gov JSON, none for a 404
+def _json_list(loc_json, list_name):
+    if 'status' in loc_json and loc_json['status'] == 404:
+        return []
+    return loc_json.get(list_name) or []
 
 # Get the JSON for any loc.gov URL
-# Will retry until it has valid JSON
+# Retries transient errors with backoff; raises LocGovFetchError if it can't get valid JSON
 # Returns the JSON, or 404 if status == 404
 def get_locgov_json(url):
-    print(url)
-    r = None
-    loc_json = None
-    while loc_json == None:
-        try:
-            r = requests.get(url)
-        except:
-            print('Time out, waiting 5 seconds')
-            time.sleep(5)
-            pass
-        if r is not None:
-            try:
-                loc_json = json.loads(r.text)
-            except:
-                #print(r)
-                #print(r.content)
-                print('Time out, waiting 5 seconds')
-                time.sleep(5)
-                pass
+    logger.debug(url)
+    loc_json = fetch_json(url)
     if 'status' in loc_json and loc_json['status'] == 404:
         return 404
     return loc_json
 
 # Return JSON for a defined and pre-constructed search URL
 def locgov_search(search_url):
-    print(search_url)
-    search = None
-    while search == None:
-        response = requests.get(search_url)
-        try:
-            search = json.loads(response.text)
-        except:
-            print('Time out, waiting 5 seconds')
-            time.sleep(5)
-            pass
-    return search
+    logger.debug(search_url)
+    return fetch_json(search_url)
 
 # Return the Item JSON for a loc.gov /item
 def locgov_item(item, locgov_server):
@@ -67,6 +485,34 @@ def locgov_item_resources(item, locgov_server):
         return 404
     return resources_json['resources']
 
+# Yield an item's Resources one at a time as the response downloads
+# For items with thousands of files this never holds the whole resources document
+def iter_item_resources(item, locgov_server):
+    url_start = 'https://%s.loc.gov/item/' % locgov_server
+    url = url_start + item + '/?fo=json&at=resources'
+    logger.debug(url)
+    yield from iter_json_list(url, 'resources')
+
+# Returns the item's full Resources keyed by resource URL, for matching search result resources
+# With summarize, each is kept as summarize(full resource) instead, as it downloads, so the
+# files of an item's resources are never all held at once
+# Ex: summarize=get_segment_stats().resource_stats (locgovsegments)
+# Returns an empty dict if the item is 404
+def locgov_item_resources_by_url(item, locgov_server, summarize=None):
+    resources_by_url = {}
+    for full_resource in iter_item_resources(item, locgov_server):
+        if 'url' in full_resource:
+            if summarize is not None:
+                resources_by_url[full_resource['url']] = summarize(full_resource)
+            else:
+                resources_by_url[full_resource['url']] = full_resource
+    return resources_by_url
+
+# Start getting an item's Resources in the background, on the shared client's prefetch threads
+# Returns a future for the result of locgov_item_resources_by_url
+def prefetch_item_resources(item, locgov_server, summarize=None):
+    return get_client().prefetch(locgov_item_resources_by_url, item, locgov_server, summarize)
+
 # Get the Item for a given Resource
 def locgov_resource_item_section(aggregate, resource_id, locgov_server):
     url_start = 'https://%s.loc.gov/resource/' % locgov_server
@@ -75,3 +521,31 @@ def locgov_resource_item_section(aggregate, resource_id, locgov_server):
     if item_json == 404:
         return 404
     return item_json['item']
+
+# Run func over items on a pool of worker threads, yielding the results
+# Results come back in input order, or as soon as each call finishes when ordered is False
+# No more than workers * 2 calls are queued ahead of the consumer, so results
+# don't pile up in memory when writing is slower than fetching
+def bounded_map(func, items, workers, ordered=True):
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield _next_result(pending, ordered)
+        while pending:
+            yield _next_result(pending, ordered)
+
+# Take the next finished call off the bounded_map queue
+def _next_result(pending, ordered):
+    if ordered:
+        future = pending.popleft()
+    else:
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        future = done.pop()
+        pending.remove(future)
+    return future.result()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Record-and-replay archive of raw loc.gov responses
+# A recording run writes every response the shared LocGovClient gets (JSON, MARCXML, error
+# pages and retries alike, and responses served from the cache) to an append-only archive
+# in WARC format: one gzip member per WARC/1.1 response record, so any record can be read
+# on its own. An SQLite index next to it (archive path + '.idx') keys the records by
+# normalized URL, the latest record for a URL winning.
+# A replay run serves every request from the archive with no network calls, so outputs can
+# be rebuilt locally after a column change, and a run's exact responses kept as fixtures.
+# Ex: configure_client(archive=ResponseArchive('run.warc.gz'))
+#     configure_client(replay=ResponseArchive('run.warc.gz', replay=True))
+
+import gzip
+import io
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+import requests
+from http.client import responses as HTTP_REASONS
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from locgovcache import normalize_url
+
+# Index key for a URL without its at= argument, and that argument's fields
+# A replayed search whose at= differs from the recorded one can be served a recording
+# whose fields cover it
+# Ex: https://www.loc.gov/search/?at=results.id,pagination&q=x -> (https://www.loc.gov/search/?q=x, 'results.id,pagination')
+def split_at(url):
+    parts = urlsplit(normalize_url(url))
+    at = ''
+    arguments = []
+    for name, value in parse_qsl(parts.query, keep_blank_values=True):
+        if name == 'at':
+            at = value
+        else:
+            arguments.append((name, value))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(arguments), '')), at
+
+# Whether a response recorded with at= fields `recorded` has every field of `wanted`
+# An empty at= is the whole document
+def at_covers(recorded, wanted):
+    if not recorded:
+        return True
+    if not wanted:
+        return False
+    recorded_fields = set(recorded.split(','))
+    for field in wanted.split(','):
+        if field not in recorded_fields and field.partition('.')[0] not in recorded_fields:
+            return False
+    return True
+
+# A response body that can be read as a stream again, for callers that parse response.raw
+class _BodyStream(io.BytesIO):
+    pass
+
+# Build a requests Response from an archived response
+def archived_response(url, status, headers, body):
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.reason = HTTP_REASONS.get(status, '')
+    response.headers.update(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers) or 'utf-8'
+    response._content = body
+    response._content_consumed = True
+    response.raw = _BodyStream(body)
+    return response
+
+class ResponseArchive:
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        self.records = 0
+        self.replayed = 0
+        self.missing = 0
+        self.lock = threading.Lock()
+        if replay and not os.path.exists(path):
+            raise FileNotFoundError('No archive to replay: %s' % path)
+        new_index = not os.path.exists(path + '.idx')
+        self.db = sqlite3.connect(path + '.idx', check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS records (
+            url TEXT PRIMARY KEY,
+            base TEXT,
+            at TEXT,
+            offset INTEGER,
+            length INTEGER,
+            status INTEGER
+        )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS records_base ON records (base)')
+        if new_index and os.path.exists(path):
+            self.rebuild_index()
+        self.file = None
+        if not replay:
+            new_archive = not os.path.exists(path) or os.path.getsize(path) == 0
+            self.file = open(path, 'ab')
+            if new_archive:
+                self._write(_warc_record('warcinfo', None, 'application/warc-fields',
+                    b'software: loc-gov-json\r\nformat: WARC File Format 1.1\r\n'))
+        self.reader = open(path, 'rb')
+
+    # Append a gzip member to the archive, returning its (offset, length)
+    # Caller must hold the lock, or be the constructor
+    def _write(self, record):
+        member = gzip.compress(record)
+        offset = self.file.tell()
+        self.file.write(member)
+        self.file.flush()
+        return offset, len(member)
+
+    # Record a response's status, content type and (decoded) body for a URL
+    def put(self, url, status, content_type, content):
+        http_headers = 'HTTP/1.1 %d %s\r\n' % (status, HTTP_REASONS.get(status, ''))
+        if content_type:
+            http_headers += 'Content-Type: %s\r\n' % content_type
+        http_headers += 'Content-Length: %d\r\n\r\n' % len(content)
+        record = _warc_record('response', url, 'application/http;msgtype=response', http_headers.encode('latin-1') + content)
+        base, at = split_at(url)
+        with self.lock:
+            offset, length = self._write(record)
+            self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)',
+                (normalize_url(url), base, at, offset, length, status))
+            self.records += 1
+
+    # Record a live response, reading its whole body
+    # A streamed response is given the body back as response.raw, so it can still be parsed as a stream
+    def record(self, url, response):
+        content = response.content
+        self.put(url, response.status_code, response.headers.get('Content-Type'), content)
+        response.raw = _BodyStream(content)
+        return response
+
+    # Return (status, headers, body) of the latest record for a URL, or None if it wasn't recorded
+    # A URL whose at= wasn't recorded gets a recording of the same URL with at= fields that cover it
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT offset, length FROM records WHERE url = ?', (normalize_url(url),)).fetchone()
+            if row is None:
+                base, at = split_at(url)
+                for recorded_at, offset, length in self.db.execute(
+                        'SELECT at, offset, length FROM records WHERE base = ? ORDER BY offset DESC', (base,)):
+                    if at_covers(recorded_at, at):
+                        row = (offset, length)
+                        break
+            if row is None:
+                self.missing += 1
+                return None
+            offset, length = row
+            self.reader.seek(offset)
+            member = self.reader.read(length)
+            self.replayed += 1
+        headers, block = _parse_warc_record(gzip.decompress(member))
+        return _parse_http_response(block)
+
+    # A requests Response for a URL from the archive, or None if it wasn't recorded
+    def response(self, url):
+        archived = self.get(url)
+        if archived is None:
+            return None
+        status, headers, body = archived
+        return archived_response(url, status, headers, body)
+
+    # Index every response record in the archive file, for an archive copied without its index
+    def rebuild_index(self):
+        rows = []
+        for offset, length, headers, block in iter_records(self.path):
+            if headers.get('WARC-Type') != 'response':
+                continue
+            url = headers['WARC-Target-URI']
+            status = _parse_http_response(block)[0]
+            base, at = split_at(url)
+            rows.append((normalize_url(url), base, at, offset, length, status))
+        with self.lock:
+            self.db.execute('DELETE FROM records')
+            self.db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    # Counters for the end of run summary
+    def stats(self):
+        if self.replay:
+            return {'replayed': self.replayed, 'missing': self.missing}
+        return {'records': self.records, 'bytes': self.file.tell()}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.reader.close()
+            self.db.close()
+
+# A WARC/1.1 record
+def _warc_record(warc_type, url, content_type, block):
+    headers = [
+        ('WARC-Type', warc_type),
+        ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+        ('WARC-Date', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+    ]
+    if url is not None:
+        headers.append(('WARC-Target-URI', url))
+    headers += [('Content-Type', content_type), ('Content-Length', str(len(block)))]
+    head = 'WARC/1.1\r\n' + ''.join('%s: %s\r\n' % header for header in headers) + '\r\n'
+    return head.encode('utf-8') + block + b'\r\n\r\n'
+
+# Split a WARC record into its headers and content block
+def _parse_warc_record(record):
+    head, _, rest = record.partition(b'\r\n\r\n')
+    headers = {}
+    for line in head.decode('utf-8').split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip()] = value.strip()
+    return headers, rest[:int(headers.get('Content-Length', len(rest)))]
+
+# Split an HTTP response block into (status, headers, body)
+def _parse_http_response(block):
+    head, _, body = block.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip()] = value.strip()
+    return status, headers, body
+
+# Yield (offset, length, WARC headers, content block) for every record in an archive file
+# A record cut off at the end of the file (a recording run that was killed) is left out
+def iter_records(path):
+    with open(path, 'rb') as archive_file:
+        offset = 0
+        data = b''
+        while True:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunks = []
+            fed = 0
+            while not decompressor.eof:
+                if not data:
+                    data = archive_file.read(65536)
+                    if not data:
+                        return
+                fed += len(data)
+                chunks.append(decompressor.decompress(data))
+                data = b''
+            data = decompressor.unused_data
+            length = fed - len(data)
+            headers, block = _parse_warc_record(b''.join(chunks))
+            yield offset, length, headers, block
+            offset += length
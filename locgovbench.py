@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Benchmark for loc-gov-json.py against a local stand-in for loc.gov
+# Serves synthetic loc.gov JSON for /collections/, /search/, /item/ and /resource/,
+# or responses recorded in a locgovcache.ResponseCache file, with configurable
+# latency, error rate and size, then runs loc-gov-json.py against it:
+#   search: a collection harvest through paged_search
+#   segments: the same harvest in segments mode (an extra resources request per item)
+#   items: the method 4 item list loop
+#   partitioned: the collection harvest split into sub-searches by the dates facet
+# Each scenario runs in its own process so its peak memory can be measured
+# Ex: python locgovbench.py --items 2000 --latency 0.05 --error-rate 0.01 --workers 8
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+from locgovcache import ResponseCache
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loc-gov-json.py')
+SCENARIOS = ['search', 'segments', 'items', 'partitioned']
+COLLECTION = 'bench'
+
+# Stand-in for the loc.gov JSON API
+# Every response is delayed by about `latency` seconds, and error_rate of them
+# fail the way loc.gov does: a 503, a 429, or an HTML error page in place of JSON
+# Search pages are further delayed by page_latency seconds for each page before them,
+# as deep pages are slower on loc.gov
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, items=500, resources=3, files=4, latency=0.0, error_rate=0.0, recorded=None, seed=0,
+            page_latency=0.0):
+        super().__init__(address, StandInHandler)
+        self.items = items
+        self.resources = resources
+        self.files = files
+        self.latency = latency
+        self.error_rate = error_rate
+        self.recorded = recorded
+        self.page_latency = page_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    # Random draws are shared by the handler threads
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate sends, which Nagle's algorithm would hold back
+    # on a keep-alive connection until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.draw()))
+        if server.draw() < server.error_rate:
+            server.count('errors')
+            self.send_error_response()
+            return
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if server.page_latency and 'sp' in query:
+            time.sleep(server.page_latency * (int(query['sp'][0]) - 1))
+        if server.recorded is None and parts.path.endswith('/marcxml'):
+            server.count('marcxml')
+            self.send_body(200, synthetic_marcxml(parts.path.split('/')[1]), 'application/xml')
+            return
+        if server.recorded is not None:
+            status, body = self.recorded_response()
+        else:
+            status, loc_json = synthetic_response(server, parts.path, query)
+            if status == 200:
+                loc_json = project(loc_json, query.get('at', [''])[0])
+            body = json.dumps(loc_json).encode('utf-8')
+        server.count('requests')
+        self.send_body(status, body, 'application/json')
+
+    def recorded_response(self):
+        cached = self.server.recorded.get('https://www.loc.gov' + self.path)
+        if cached is None:
+            return 404, b'{"status": 404}'
+        return cached
+
+    def send_error_response(self):
+        choice = self.server.draw()
+        if choice < 1 / 3:
+            self.send_body(503, b'Service Unavailable', 'text/plain', {'Retry-After': '0'})
+        elif choice < 2 / 3:
+            self.send_body(429, b'Too Many Requests', 'text/plain', {'Retry-After': '0'})
+        else:
+            self.send_body(200, b'<html><body>If you are seeing this error, please try again.</body></html>', 'text/html')
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+# Build (status, JSON) for a synthetic loc.gov URL
+# Item IDs are bench00000, bench00001, ... up to server.items; others are 404
+def synthetic_response(server, path, query):
+    segments = [segment for segment in path.split('/') if segment]
+    if len(segments) >= 2 and segments[0] == 'item':
+        server.count('item')
+        item_number = synthetic_item_number(server, segments[1])
+        if item_number is None:
+            return 404, {'status': 404}
+        return 200, {'item': synthetic_item(server, item_number), 'resources': synthetic_resources(server, item_number)}
+    if len(segments) >= 2 and segments[0] == 'resource':
+        server.count('resource')
+        item_number = synthetic_item_number(server, segments[1].split('.')[0])
+        if item_number is None:
+            return 404, {'status': 404}
+        return 200, {'item': synthetic_item(server, item_number)}
+    if segments[:1] in (['collections'], ['search']):
+        server.count('search')
+        page_size = int(query.get('c', ['100'])[0])
+        page = int(query.get('sp', ['1'])[0])
+        first = (page - 1) * page_size
+        matches = [i for i in range(server.items) if synthetic_item_matches(i, query)]
+        return 200, {
+            'search': {'in': query.get('q', [segments[-1]])[0], 'hits': len(matches)},
+            'pagination': {'current': page, 'total': max(1, -(-len(matches) // page_size))},
+            'results': [synthetic_item(server, i) for i in matches[first:first + page_size]],
+            'facets': synthetic_facets(server, path, query, matches),
+        }
+    return 404, {'status': 404}
+
+# Synthetic facet values: every item has a year, so dates cover them all; most items
+# have one subject, every tenth a second one, and every 23rd none, so subjects overlap
+# and leave gaps the way real facets do
+def synthetic_year(item_number):
+    return 1850 + (item_number * 7) % 150
+
+def synthetic_subjects(item_number):
+    if item_number % 23 == 0:
+        return []
+    subjects = ['subject %d' % (item_number % 5)]
+    if item_number % 10 == 0:
+        subjects.append('subject %d' % ((item_number + 1) % 5))
+    return subjects
+
+# Whether an item passes a search's dates=YYYY/YYYY, fa=subject:... and fa=subject!:... (not) filters
+def synthetic_item_matches(item_number, query):
+    if 'dates' in query:
+        start, _, end = query['dates'][0].partition('/')
+        if not int(start) <= synthetic_year(item_number) <= int(end or start):
+            return False
+    for facet_filter in query.get('fa', []):
+        for term in facet_filter.split('|'):
+            name, _, value = term.partition(':')
+            if name == 'subject' and value not in synthetic_subjects(item_number):
+                return False
+            if name == 'subject!' and value in synthetic_subjects(item_number):
+                return False
+    return True
+
+# dates (by decade) and subject facets for the items a search matched,
+# each filter with an "on" URL adding it to the search, and subjects with a "not" URL too
+def synthetic_facets(server, path, query, matches):
+    decades = {}
+    subjects = {}
+    for i in matches:
+        decade = synthetic_year(i) // 10 * 10
+        decades[decade] = decades.get(decade, 0) + 1
+        for subject in synthetic_subjects(i):
+            subjects[subject] = subjects.get(subject, 0) + 1
+    def on_url(name, value):
+        arguments = [(key, value) for key, values in query.items() for value in values if key not in ('sp', 'at', 'c', 'fo')]
+        arguments.append((name, value))
+        return 'https://www.loc.gov%s?%s' % (path, urlencode(arguments))
+    return [
+        {'type': 'dates', 'filters': [{
+            'term': '%d/%d' % (decade, decade + 9), 'title': '%ds' % decade, 'count': count,
+            'on': on_url('dates', '%d/%d' % (decade, decade + 9)),
+        } for decade, count in sorted(decades.items())]},
+        {'type': 'subject', 'filters': [{
+            'term': subject, 'title': subject, 'count': count,
+            'on': on_url('fa', 'subject:' + subject),
+            'not': on_url('fa', 'subject!:' + subject),
+        } for subject, count in sorted(subjects.items())]},
+    ]
+
+def synthetic_item_number(server, item_id):
+    try:
+        item_number = int(item_id[len(COLLECTION):])
+    except ValueError:
+        return None
+    if not item_id.startswith(COLLECTION) or item_number >= server.items:
+        return None
+    return item_number
+
+def synthetic_item_id(item_number):
+    return '%s%05d' % (COLLECTION, item_number)
+
+# A search result or item, with its resource summaries
+def synthetic_item(server, item_number):
+    item_id = synthetic_item_id(item_number)
+    return {
+        'id': 'https://www.loc.gov/item/%s/' % item_id,
+        'title': 'Benchmark item %d' % item_number,
+        'date': str(synthetic_year(item_number)),
+        'subject': synthetic_subjects(item_number),
+        'digitized': True,
+        'number_lccn': [item_id],
+        'online_format': ['image', 'online text'],
+        'mime_type': ['image/jpeg', 'image/tiff', 'text/plain'],
+        'partof': ['benchmark collection'],
+        'group': [COLLECTION],
+        'other_formats': [{'label': 'MARCXML Record', 'link': 'https://lccn.loc.gov/%s/marcxml' % item_id}],
+        'resources': [{
+            'url': 'https://www.loc.gov/resource/%s.%04d/' % (item_id, r),
+            'caption': 'Resource %d' % r,
+            'files': server.files,
+            'representative_index': 0,
+        } for r in range(server.resources)],
+    }
+
+# An item's full resources, as returned with at=resources
+def synthetic_resources(server, item_number):
+    item_id = synthetic_item_id(item_number)
+    return [{
+        'url': 'https://www.loc.gov/resource/%s.%04d/' % (item_id, r),
+        'caption': 'Resource %d' % r,
+        'files': [[
+            {'use': 'master', 'mimetype': 'image/tiff', 'size': 24000000,
+                'url': 'https://tile.loc.gov/storage-services/%s/%04d/%04d.tif' % (item_id, r, f)},
+            {'use': 'text', 'mimetype': 'text/plain', 'size': 2400,
+                'url': 'https://tile.loc.gov/storage-services/%s/%04d/%04d.txt' % (item_id, r, f)},
+            {'mimetype': 'image/jpeg',
+                'url': 'https://tile.loc.gov/image-services/iiif/service:%s:%04d:%04d/full/pct:25/0/default.jpg' % (item_id, r, f)},
+        ] for f in range(server.files)],
+    } for r in range(server.resources)]
+
+# A MARCXML record, as served by lccn.loc.gov
+def synthetic_marcxml(item_id):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<record xmlns="http://www.loc.gov/MARC21/slim">'
+        '<leader>00000cam a2200000 a 4500</leader>'
+        '<controlfield tag="001">%s</controlfield>'
+        '<datafield tag="245" ind1="0" ind2="0"><subfield code="a">Benchmark item %s</subfield></datafield>'
+        '</record>\n' % (item_id, item_id)).encode('utf-8')
+
+# Keep only the fields named in a loc.gov at= argument
+# Ex: at=results.id,pagination keeps results (with just their id) and pagination
+def project(loc_json, at):
+    if not at:
+        return loc_json
+    fields = {}
+    for name in at.split(','):
+        top, _, sub = name.partition('.')
+        fields.setdefault(top, [])
+        if sub:
+            fields[top].append(sub)
+    projected = {}
+    for top, subs in fields.items():
+        if top not in loc_json:
+            continue
+        value = loc_json[top]
+        if subs and isinstance(value, list):
+            value = [{key: entry[key] for key in subs if key in entry} for entry in value]
+        elif subs and isinstance(value, dict):
+            value = {key: value[key] for key in subs if key in value}
+        projected[top] = value
+    return projected
+
+# Item IDs with a recorded item response, for the items scenario in recorded mode
+def recorded_item_ids(recorded):
+    item_ids = []
+    for (url,) in recorded.db.execute("SELECT url FROM responses WHERE url LIKE '%/item/%'"):
+        item_id = urlsplit(url).path.split('/')[2]
+        if item_id not in item_ids:
+            item_ids.append(item_id)
+    return item_ids
+
+# Run loc-gov-json.py for one scenario against the stand-in server
+# Returns the scenario's throughput figures and the peak RSS of its process
+def run_scenario(scenario, server, args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        metrics_path = os.path.join(output_dir, 'metrics.json')
+        command = [sys.executable, SCRIPT, '--batch', '--base-url', server.base_url(),
+            '--output-dir', output_dir, '--format', 'jsonl', '--workers', str(args.workers),
+            '--page-size', str(args.page_size), '--rate-limit', args.rate_limit,
+            '--metrics', metrics_path, '--log-level', 'WARNING']
+        if scenario in ('search', 'segments', 'partitioned'):
+            command += ['--method', 'collection', '--value', args.collection]
+        if scenario == 'partitioned':
+            command += ['--partition', 'dates', '--partition-pages', str(args.partition_pages)]
+        if scenario == 'segments':
+            command += ['--segments', 'yes']
+        if scenario == 'items':
+            if server.recorded is not None:
+                item_ids = recorded_item_ids(server.recorded)
+            else:
+                item_ids = [synthetic_item_id(i) for i in range(server.items)]
+            input_path = os.path.join(output_dir, 'items.csv')
+            with open(input_path, 'w', encoding='utf-8', newline='') as input_file:
+                writer = csv.writer(input_file)
+                writer.writerow(['item_id'])
+                for item_id in item_ids:
+                    writer.writerow([item_id])
+            command += ['--method', 'items', '--input', input_path]
+
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        # wait4 gives the resource usage of just this process
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.monotonic() - start
+        if process.returncode != 0:
+            raise RuntimeError('%s scenario failed with exit code %d' % (scenario, process.returncode))
+
+        item_rows = 0
+        resource_rows = 0
+        for name in os.listdir(output_dir):
+            if name.startswith('OUTPUT-loc_gov_items') and name.endswith('.jsonl') and 'checkpoint' not in name:
+                item_rows += count_lines(os.path.join(output_dir, name))
+            if name.startswith('OUTPUT-loc_gov_resources') and name.endswith('.jsonl'):
+                resource_rows += count_lines(os.path.join(output_dir, name))
+        with open(metrics_path, 'r', encoding='utf-8') as metrics_file:
+            metrics = json.load(metrics_file)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = usage.ru_maxrss * 1024 if sys.platform != 'darwin' else usage.ru_maxrss
+    search = metrics['endpoints'].get('search', {'requests': 0})
+    # The first search request only gets the totals
+    pages = max(0, search['requests'] - 1) if scenario != 'items' else 0
+    return {
+        'scenario': scenario,
+        'seconds': round(elapsed, 3),
+        'pages': pages,
+        'items': item_rows,
+        'resources': resource_rows,
+        'pages_per_second': round(pages / elapsed, 2),
+        'items_per_second': round(item_rows / elapsed, 2),
+        'resources_per_second': round(resource_rows / elapsed, 2),
+        'requests': metrics['requests'],
+        'retries': metrics['retries'],
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+    }
+
+def count_lines(path):
+    with open(path, 'rb') as output_file:
+        return sum(1 for line in output_file)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark loc-gov-json.py against a local stand-in for loc.gov.')
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+        help='scenario to run, can be repeated (default all)')
+    parser.add_argument('--items', type=int, default=500, help='synthetic items in the collection (default 500)')
+    parser.add_argument('--resources', type=int, default=3, help='resources per synthetic item (default 3)')
+    parser.add_argument('--files', type=int, default=4, help='files per synthetic resource (default 4)')
+    parser.add_argument('--page-size', type=int, default=100, help='search results per page (default 100)')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean seconds the server takes per response (default 0.02)')
+    parser.add_argument('--page-latency', type=float, default=0.0,
+        help='extra seconds for each search page before the one asked for, as deep pages are slower (default 0)')
+    parser.add_argument('--partition-pages', type=int, default=2,
+        help='loc-gov-json.py --partition-pages for the partitioned scenario (default 2)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses that fail (default 0)')
+    parser.add_argument('--workers', type=int, default=4, help='loc-gov-json.py --workers (default 4)')
+    parser.add_argument('--rate-limit', choices=['adaptive', 'off'], default='off',
+        help='loc-gov-json.py --rate-limit (default off, to measure the harvester itself)')
+    parser.add_argument('--recorded', metavar='CACHE',
+        help='serve the responses recorded in this response cache file instead of synthetic ones')
+    parser.add_argument('--collection', default=COLLECTION,
+        help='collection to harvest, for recorded responses (default %s)' % COLLECTION)
+    parser.add_argument('--seed', type=int, default=0, help='random seed for latency and errors (default 0)')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to this file as JSON')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    recorded = None
+    if args.recorded:
+        # Recorded responses never expire
+        recorded = ResponseCache(args.recorded, ttl=float('inf'), negative_ttl=float('inf'))
+    server = StandInServer(('127.0.0.1', 0), args.items, args.resources, args.files,
+        args.latency, args.error_rate, recorded, args.seed, args.page_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Stand-in server: ', server.base_url())
+
+    results = []
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            result = run_scenario(scenario, server, args)
+            results.append(result)
+            print('%-11s %7.2fs %7.1f pages/s %8.1f items/s %9.1f resources/s %6d requests %5d retries  peak RSS %.1f MB' % (
+                scenario, result['seconds'], result['pages_per_second'], result['items_per_second'],
+                result['resources_per_second'], result['requests'], result['retries'], result['peak_rss_mb']))
+    finally:
+        server.shutdown()
+        print('Stand-in server responses: ', server.counts)
+        if recorded is not None:
+            recorded.close()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump({'settings': vars(args), 'results': results}, json_file, indent=2)
+            json_file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Persistent on-disk cache for loc.gov JSON responses
+# Used by locgov.py when a cache is given to the shared LocGovClient
+# Ex: configure_client(cache=ResponseCache('locgov_cache.sqlite'))
+
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# How long responses stay fresh, in seconds
+# 404s are kept for less time in case the item is published later
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_NEGATIVE_TTL = 24 * 60 * 60
+# Size of stored (compressed) bodies before the least recently used are evicted
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Build the cache key for a URL
+# Query arguments are sorted by name so the same request built in a different order is a hit
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    query = sorted(parse_qsl(parts.query, keep_blank_values=True), key=lambda arg: arg[0])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+# SQLite-backed response cache, safe to share between worker threads
+class ResponseCache:
+    def __init__(self, path, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            status INTEGER,
+            body BLOB,
+            size INTEGER,
+            fetched REAL,
+            accessed REAL
+        )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    # Return (status, body bytes) for a cached URL, or None if it isn't cached or has expired
+    def get(self, url):
+        key = normalize_url(url)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT status, body, size, fetched FROM responses WHERE url = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            status, body, size, fetched = row
+            ttl = self.negative_ttl if status == 404 else self.ttl
+            if now - fetched > ttl:
+                self.db.execute('DELETE FROM responses WHERE url = ?', (key,))
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, key))
+            if status == 404:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+        return status, zlib.decompress(body)
+
+    # Store the response body bytes for a URL
+    def put(self, url, status, content):
+        key = normalize_url(url)
+        body = zlib.compress(content)
+        now = time.time()
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE url = ?', (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, status, body, len(body), now, now))
+            self.total_bytes += len(body)
+            self.stores += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    # Drop least recently used responses until the cache is back under 90% of max_bytes
+    # Caller must hold the lock
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        evict = []
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY accessed'):
+            if self.total_bytes <= target:
+                break
+            evict.append((url,))
+            self.total_bytes -= size
+        self.db.executemany('DELETE FROM responses WHERE url = ?', evict)
+        self.evictions += len(evict)
+
+    # Counters for the end of run summary
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Checkpoint journal for long loc.gov harvests
+# Records the last completed page of each search and the completed item IDs,
+# together with the size of the item and resource outputs at that point.
+# A stopped run can then be resumed: the outputs are cut back to the last
+# checkpoint and reopened for appending, so no row is written twice.
+# Output that can't be cut back (Parquet, compressed or rotated) gets a checkpoint with
+# no journal, which tracks the run's progress in memory only.
+
+import json
+import os
+from collections import Counter
+
+# Number of finished items recorded between checkpoints for item lists
+ITEM_BATCH_SIZE = 100
+
+class Checkpoint:
+    def __init__(self, path, settings, item_output, resource_output):
+        self.path = path
+        self.settings = settings
+        self.item_output = item_output
+        self.resource_output = resource_output
+        self.item_bytes = 0
+        self.resource_bytes = 0
+        self.pages = {}
+        self.done_queries = set()
+        # Items done when the checkpoint was loaded, with how many copies of each ID in the
+        # input list were done; items finished in this run aren't added, so repeated IDs are all written
+        self.done_items = Counter()
+        self.pending_pages = {}
+        self.pending_queries = []
+        self.pending_items = []
+        self.item_file = None
+        self.resource_file = None
+        self.journal = None
+
+    # Give the checkpoint the open output files it flushes and measures
+    def attach(self, item_file, resource_file):
+        self.item_file = item_file
+        self.resource_file = resource_file
+        if self.path is not None:
+            self.journal = open(self.path, 'a', encoding='utf-8')
+
+    # Last completed page for a search seed URL, 0 if none
+    def last_page(self, seed):
+        return self.pages.get(seed, 0)
+
+    def query_is_done(self, seed):
+        return seed in self.done_queries
+
+    # Whether an item from the item list was done before the run resumed
+    # Each done copy of an ID skips one copy of it in the input list, in input order
+    def item_is_done(self, item_id):
+        if self.done_items[item_id] > 0:
+            self.done_items[item_id] -= 1
+            return True
+        return False
+
+    # A page of results has been written
+    def page_done(self, seed, page):
+        self.pages[seed] = page
+        self.pending_pages[seed] = page
+        self.commit()
+
+    # Every page of a search has been written
+    def query_done(self, seed):
+        self.done_queries.add(seed)
+        self.pending_queries.append(seed)
+        self.commit()
+
+    # An item from the item list has been written
+    # Checkpoints are taken every ITEM_BATCH_SIZE items rather than for every item
+    def item_done(self, item_id):
+        self.pending_items.append(item_id)
+        if len(self.pending_items) >= ITEM_BATCH_SIZE:
+            self.commit()
+
+    # Flush the outputs and record their sizes with everything finished since the last checkpoint
+    # Without a journal there is nothing to record
+    def commit(self):
+        if self.journal is None:
+            self.pending_pages = {}
+            self.pending_queries = []
+            self.pending_items = []
+            return
+        self.item_file.flush()
+        self.resource_file.flush()
+        self.item_bytes = os.fstat(self.item_file.fileno()).st_size
+        self.resource_bytes = os.fstat(self.resource_file.fileno()).st_size
+        entry = {
+            'pages': self.pending_pages,
+            'queries': self.pending_queries,
+            'items': self.pending_items,
+            'item_bytes': self.item_bytes,
+            'resource_bytes': self.resource_bytes,
+        }
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending_pages = {}
+        self.pending_queries = []
+        self.pending_items = []
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+# Start a new checkpoint journal for a run
+# settings are the run's options, used to check that a resumed run matches
+def start_checkpoint(path, settings, item_output, resource_output):
+    checkpoint = Checkpoint(path, settings, item_output, resource_output)
+    header = {
+        'settings': settings,
+        'item_output': item_output,
+        'resource_output': resource_output,
+    }
+    with open(path, 'w', encoding='utf-8') as journal:
+        journal.write(json.dumps(header) + '\n')
+    return checkpoint
+
+# Checkpoint with no journal, for a run whose output can't be resumed
+def untracked_checkpoint(settings, item_output, resource_output):
+    return Checkpoint(None, settings, item_output, resource_output)
+
+# Load a checkpoint journal to resume a run
+# The item and resource outputs are cut back to their size at the last checkpoint,
+# dropping any rows written after it, so they can be reopened for appending
+# If no checkpoint was taken yet, both sizes are 0 and the outputs start over
+def resume_checkpoint(path):
+    with open(path, 'r', encoding='utf-8') as journal:
+        lines = journal.readlines()
+    header = json.loads(lines[0])
+    checkpoint = Checkpoint(path, header['settings'], header['item_output'], header['resource_output'])
+    good_lines = lines[:1]
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Last line was cut off mid-write; everything before it is still good
+            break
+        good_lines.append(line)
+        checkpoint.pages.update(entry['pages'])
+        checkpoint.done_queries.update(entry['queries'])
+        checkpoint.done_items.update(entry['items'])
+        checkpoint.item_bytes = entry['item_bytes']
+        checkpoint.resource_bytes = entry['resource_bytes']
+    if len(good_lines) < len(lines):
+        with open(path, 'w', encoding='utf-8') as journal:
+            journal.writelines(good_lines)
+    for output, size in [(checkpoint.item_output, checkpoint.item_bytes), (checkpoint.resource_output, checkpoint.resource_bytes)]:
+        if os.path.exists(output):
+            os.truncate(output, size)
+    return checkpoint
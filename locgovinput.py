@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Streaming input lists for item lists (method 4) and query lists (method 5)
+# The input CSV is read as the harvest goes rather than loaded first, so a list of millions
+# of IDs starts producing output straight away and is never held in memory. A reader thread
+# keeps up to read_ahead values queued for the fetch stage; when the harvest falls behind,
+# the queue fills and the reader waits, so memory stays bounded however long the list is.
+# Inputs can be plain CSV, gzip-compressed CSV (ending in .gz), or '-' for stdin.
+# Ex: for item_id in read_input_column('items.csv.gz', 'item_id'): ...
+
+import csv
+import gzip
+import io
+import queue
+import sys
+import threading
+from dcmhelpers import testRequiredInput
+from locgovshard import in_shard
+
+# Input values queued ahead of the fetch stage
+DEFAULT_READ_AHEAD = 10000
+
+# Open an input list: a CSV file, gzip-compressed if it ends in .gz, or '-' for stdin
+def open_input(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8-sig')
+    return open(path, 'r', encoding='utf-8-sig')
+
+# Values of one column of an input list, read lazily on a reader thread
+# The header is checked straight away (testRequiredInput exits if the column is missing)
+# With shard (I, N), only the values in that shard are given
+def read_input_column(path, column, shard=None, read_ahead=DEFAULT_READ_AHEAD):
+    input_file = open_input(path)
+    reader = csv.DictReader(input_file)
+    testRequiredInput(reader.fieldnames, [column])
+    return read_ahead_values(_column_values(input_file, reader, column, shard), read_ahead)
+
+def _column_values(input_file, reader, column, shard):
+    try:
+        for row in reader:
+            value = row[column]
+            if shard is None or in_shard(value, shard):
+                yield value
+    finally:
+        input_file.close()
+
+_END = object()
+
+# Yield from values, read ahead by up to size values on a separate thread
+# An error reading the values is raised here, where they are consumed
+def read_ahead_values(values, size=DEFAULT_READ_AHEAD):
+    pending = queue.Queue(maxsize=size)
+
+    def read():
+        try:
+            for value in values:
+                pending.put(value)
+        except Exception as e:
+            pending.put(e)
+            return
+        pending.put(_END)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        value = pending.get()
+        if value is _END:
+            return
+        if isinstance(value, Exception):
+            raise value
+        yield value
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Manifests for incremental harvests
+# A manifest holds every item a search (a collection, part of, or query) returned on its
+# last full run, with a marker for each, so the next run can write only the items that
+# are new or changed and report the ones that are gone.
+# loc.gov search results have no modified date that covers every field, so the marker is
+# a digest of the result fields the harvest asks for: any change to what would be written
+# changes the marker. Changes only in an item's full resources (segments mode) aren't seen.
+# Manifests are gzipped text, one "item URL<TAB>marker" line per item, one file per search.
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+
+# Marker for a search result, a short digest of its fields
+def result_marker(result):
+    values = json.dumps(result, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(values.encode('utf-8'), digest_size=8).hexdigest()
+
+# Manifest file for a search seed URL in manifest_dir
+# Ex: collections-rare-book-selections-3f2a9c1d.tsv.gz
+def manifest_path(manifest_dir, seed):
+    name = re.sub(r'^https?://[^/]+/', '', seed)
+    name = re.sub(r'[^A-Za-z0-9]+', '-', name).strip('-')[:80]
+    digest = hashlib.blake2b(seed.encode('utf-8'), digest_size=4).hexdigest()
+    return os.path.join(manifest_dir, '%s-%s.tsv.gz' % (name, digest))
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.items = {}
+        self.seen = {}
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as manifest:
+                for line in manifest:
+                    item, marker = line.rstrip('\n').split('\t')
+                    self.items[item] = marker
+
+    # Record a search result from this run
+    # Returns True if it is new or changed since the last run and should be written
+    # Safe to call from the page worker threads
+    def check(self, item, marker):
+        with self.lock:
+            self.seen[item] = marker
+            last_marker = self.items.get(item)
+            if last_marker is None:
+                self.new += 1
+                return True
+            if last_marker != marker:
+                self.changed += 1
+                return True
+            self.unchanged += 1
+            return False
+
+    # Items in the manifest that this run hasn't seen
+    # Only meaningful once every page of the search has been seen
+    def removed(self):
+        return [item for item in self.items if item not in self.seen]
+
+    # Save the items seen by this run as the new manifest
+    # complete is False when the run didn't see every page (it was resumed part way through);
+    # the items it didn't see are then kept as they were rather than dropped
+    def save(self, complete=True):
+        items = self.seen
+        if not complete:
+            items = dict(self.items)
+            items.update(self.seen)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as manifest:
+            for item, marker in items.items():
+                manifest.write('%s\t%s\n' % (item, marker))
+        os.replace(temp_path, self.path)
+
+# Load the manifest for a search seed URL, empty if this is its first incremental run
+def open_manifest(manifest_dir, seed):
+    return Manifest(manifest_path(manifest_dir, seed))
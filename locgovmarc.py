@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Bulk MARCXML harvesting into one compressed MARC collection file
+# Item IDs go through a pipeline on worker threads: get the item's other formats from the
+# loc.gov server being harvested, find its MARCXML link, and stream the MARCXML download
+# through an XML pull parser, so each record is written to the collection as it is parsed.
+# No more than workers * 2 item IDs wait in the queue, so a harvest feeding it faster than
+# the records download is held back rather than piling up IDs in memory.
+# Ex: harvest_marcxml(['2014717546', '2002716760'], 'records.xml.gz', workers=4, locgov_server='www')
+
+import gzip
+import logging
+import queue
+import threading
+import xml.etree.ElementTree as ElementTree
+from dcmhelpers import get_marcxml_link, iter_marcxml_records, MARCXML_NAMESPACE
+from locgov import get_locgov_json, LocGovFetchError
+
+logger = logging.getLogger('locgov.marc')
+
+ElementTree.register_namespace('marc', MARCXML_NAMESPACE)
+
+# A MARCXML collection file, gzip-compressed when the path ends in .gz
+class MarcCollectionWriter:
+    def __init__(self, path):
+        if path.endswith('.gz'):
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<marc:collection xmlns:marc="%s">\n' % MARCXML_NAMESPACE)
+
+    def write(self, record):
+        self.file.write(ElementTree.tostring(record, encoding='unicode'))
+        self.file.write('\n')
+
+    def close(self):
+        self.file.write('</marc:collection>\n')
+        self.file.close()
+
+# locgov_server is the loc.gov server (www, test or dev) the items' other formats come from
+class MarcxmlPipeline:
+    def __init__(self, path, workers=4, locgov_server='www'):
+        self.locgov_server = locgov_server
+        self.writer = MarcCollectionWriter(path)
+        self.queue = queue.Queue(maxsize=workers * 2)
+        self.lock = threading.Lock()
+        self.counts = {'items': 0, 'records': 0, 'no_marcxml': 0, 'errors': 0}
+        self.threads = [threading.Thread(target=self._work, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # Queue an item for its MARCXML, waiting while the queue is full
+    def submit(self, item_id):
+        self.queue.put(item_id)
+
+    def _work(self):
+        while True:
+            item_id = self.queue.get()
+            if item_id is None:
+                return
+            # Any other error (such as a dropped connection partway through a download) is
+            # counted against the item, so the worker carries on and submit() can't block forever
+            try:
+                self._harvest(item_id)
+            except Exception as e:
+                logger.error('Could not get MARCXML for item %s: %r', item_id, e)
+                self._count('errors')
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _harvest(self, item_id):
+        self._count('items')
+        # Only the field the MARCXML link is in
+        url = 'https://%s.loc.gov/item/%s/?fo=json&at=item.other_formats' % (self.locgov_server, item_id)
+        try:
+            loc_gov_json = get_locgov_json(url)
+        except LocGovFetchError as e:
+            logger.error('Could not get the formats of item %s: %s', item_id, e)
+            self._count('errors')
+            return
+        if loc_gov_json == 404:
+            self._count('errors')
+            return
+        try:
+            url = get_marcxml_link(loc_gov_json)
+        except KeyError:
+            url = None
+        if url is None:
+            self._count('no_marcxml')
+            return
+        try:
+            for record in iter_marcxml_records(url):
+                with self.lock:
+                    self.writer.write(record)
+                    self.counts['records'] += 1
+        except (LocGovFetchError, ElementTree.ParseError) as e:
+            # Records written before the error are complete, so the collection stays valid
+            logger.error('Could not get MARCXML for item %s from %s: %s', item_id, url, e)
+            self._count('errors')
+
+    # Finish the queued items and close the collection file
+    # Returns the counts of items, records written, items without MARCXML, and errors
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.writer.close()
+        return self.counts
+
+# Write the MARCXML records for a list of item IDs to a MARC collection file
+def harvest_marcxml(item_ids, path, workers=4, locgov_server='www'):
+    pipeline = MarcxmlPipeline(path, workers, locgov_server)
+    for item_id in item_ids:
+        pipeline.submit(item_id)
+    return pipeline.close()
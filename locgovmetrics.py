@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Request metrics for loc.gov harvests
+# The shared LocGovClient records every HTTP request here: latency, bytes, status,
+# and retries, grouped by endpoint type (search, item, resources, resource, marcxml)
+# Ex: print(format_report(get_client().metrics.summary()))
+
+import bisect
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+ENDPOINT_TYPES = ['search', 'item', 'resources', 'resource', 'marcxml', 'other']
+
+# Upper bounds of the latency histogram buckets, in seconds
+# Each bucket is about 19% wider than the last, from 1 ms to about 2 minutes,
+# so percentiles read from them are within that much of the true value
+LATENCY_BUCKETS = [round(0.001 * 2 ** (i / 4), 6) for i in range(68)]
+
+# Buckets written out in the Prometheus export
+# Each counts the requests in the LATENCY_BUCKETS that end at or below its bound
+PROMETHEUS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+PERCENTILES = [50, 90, 99]
+
+# Endpoint type of a loc.gov URL
+def endpoint_type(url):
+    parts = urlsplit(url)
+    path = parts.path.lower()
+    if 'marcxml' in path or 'fo=marcxml' in parts.query:
+        return 'marcxml'
+    if '/resource/' in path:
+        return 'resource'
+    if '/item/' in path or parts.netloc.startswith('lccn.'):
+        if 'at=resources' in parts.query:
+            return 'resources'
+        return 'item'
+    if '/search/' in path or '/collections/' in path or 'q=' in parts.query:
+        return 'search'
+    return 'other'
+
+# Counters and a latency histogram for one endpoint type
+class EndpointMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.bytes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.statuses = {}
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add_request(self, latency, status, size):
+        self.requests += 1
+        self.bytes += size
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    # Latency at a percentile, read as the upper bound of the bucket it falls in
+    def percentile(self, percent):
+        if self.requests == 0:
+            return None
+        rank = self.requests * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                if i == len(LATENCY_BUCKETS):
+                    return round(self.latency_max, 4)
+                return min(LATENCY_BUCKETS[i], round(self.latency_max, 4))
+        return round(self.latency_max, 4)
+
+    # Number of requests that took no longer than `bound` seconds
+    def count_within(self, bound):
+        return sum(self.buckets[:bisect.bisect_right(LATENCY_BUCKETS, bound)])
+
+    def summary(self):
+        latency = {'p%d' % percent: self.percentile(percent) for percent in PERCENTILES}
+        latency['mean'] = round(self.latency_total / self.requests, 4) if self.requests else None
+        latency['max'] = round(self.latency_max, 4)
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'cache_hits': self.cache_hits,
+            'bytes': self.bytes,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=lambda s: str(s[0]))},
+            'latency_seconds': latency,
+        }
+
+# Request metrics for a whole run, safe to share between worker threads
+class FetchMetrics:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    # Caller must hold the lock
+    def _endpoint(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = EndpointMetrics()
+        return self.endpoints[endpoint]
+
+    # One HTTP request: status is the HTTP status, or the exception name if there was no response
+    # size is the body size in bytes as received (compressed, if the server compressed it)
+    def record_request(self, endpoint, latency, status, size):
+        with self.lock:
+            self._endpoint(endpoint).add_request(latency, status, size)
+
+    # One fetch, after its retries: attempts is the number of requests it took
+    def record_fetch(self, endpoint, attempts, failed=False):
+        with self.lock:
+            metrics = self._endpoint(endpoint)
+            metrics.retries += attempts - 1
+            if failed:
+                metrics.failures += 1
+
+    # A response served from the response cache without a request
+    def record_cache_hit(self, endpoint):
+        with self.lock:
+            self._endpoint(endpoint).cache_hits += 1
+
+    # Totals, throughput and per-endpoint figures for the run so far
+    def summary(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            endpoints = {endpoint: self.endpoints[endpoint].summary()
+                for endpoint in ENDPOINT_TYPES if endpoint in self.endpoints}
+        requests = sum(endpoint['requests'] for endpoint in endpoints.values())
+        size = sum(endpoint['bytes'] for endpoint in endpoints.values())
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'requests': requests,
+            'retries': sum(endpoint['retries'] for endpoint in endpoints.values()),
+            'failures': sum(endpoint['failures'] for endpoint in endpoints.values()),
+            'cache_hits': sum(endpoint['cache_hits'] for endpoint in endpoints.values()),
+            'bytes': size,
+            'requests_per_second': round(requests / max(elapsed, 0.001), 2),
+            'bytes_per_second': round(size / max(elapsed, 0.001), 1),
+            'endpoints': endpoints,
+        }
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self):
+        with self.lock:
+            endpoints = [(endpoint, self.endpoints[endpoint]) for endpoint in ENDPOINT_TYPES if endpoint in self.endpoints]
+            lines = [
+                '# HELP locgov_requests_total HTTP requests to loc.gov by endpoint type and status.',
+                '# TYPE locgov_requests_total counter',
+            ]
+            for endpoint, metrics in endpoints:
+                for status, count in sorted(metrics.statuses.items(), key=lambda s: str(s[0])):
+                    lines.append('locgov_requests_total{endpoint="%s",status="%s"} %d' % (endpoint, status, count))
+            for name, attribute, description in [
+                ('locgov_retries_total', 'retries', 'Requests that were retries of a failed attempt.'),
+                ('locgov_failures_total', 'failures', 'Fetches that failed after all retries.'),
+                ('locgov_cache_hits_total', 'cache_hits', 'Responses served from the response cache.'),
+                ('locgov_response_bytes_total', 'bytes', 'Response body bytes received.'),
+            ]:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s counter' % name)
+                for endpoint, metrics in endpoints:
+                    lines.append('%s{endpoint="%s"} %d' % (name, endpoint, getattr(metrics, attribute)))
+            lines.append('# HELP locgov_request_duration_seconds HTTP request latency by endpoint type.')
+            lines.append('# TYPE locgov_request_duration_seconds histogram')
+            for endpoint, metrics in endpoints:
+                for bound in PROMETHEUS_BUCKETS:
+                    lines.append('locgov_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                        % (endpoint, bound, metrics.count_within(bound)))
+                lines.append('locgov_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (endpoint, metrics.requests))
+                lines.append('locgov_request_duration_seconds_sum{endpoint="%s"} %.6f' % (endpoint, metrics.latency_total))
+                lines.append('locgov_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, metrics.requests))
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to a file as 'json' (the summary) or 'prometheus' text
+    def export(self, path, metrics_format='json'):
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            if metrics_format == 'prometheus':
+                metrics_file.write(self.prometheus())
+            else:
+                json.dump(self.summary(), metrics_file, indent=2)
+                metrics_file.write('\n')
+
+# Lines for the end of run report from a summary()
+def format_report(summary):
+    lines = ['%d requests in %.1f seconds (%.1f requests/second, %.1f KB/second), %d retries, %d failures, %d cache hits' % (
+        summary['requests'], summary['elapsed_seconds'], summary['requests_per_second'],
+        summary['bytes_per_second'] / 1024, summary['retries'], summary['failures'], summary['cache_hits'])]
+    for endpoint, metrics in summary['endpoints'].items():
+        latency = metrics['latency_seconds']
+        if metrics['requests']:
+            timing = 'latency p50 %.3fs p90 %.3fs p99 %.3fs max %.3fs' % (latency['p50'], latency['p90'], latency['p99'], latency['max'])
+        else:
+            timing = 'no requests'
+        lines.append('  %-9s %6d requests %6d retries %10d bytes, %s, statuses %s' % (
+            endpoint, metrics['requests'], metrics['retries'], metrics['bytes'], timing, metrics['statuses']))
+    return '\n'.join(lines)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Facet-partitioned searches, for collections and queries too large to page through
+# loc.gov serves deep search pages (a high sp=) more slowly the deeper they are, so a search
+# with more than max_pages pages is split into sub-searches, one for each value of a facet
+# such as dates or subject (the "on" URL of the facet's filter), that can be paged through
+# side by side. A sub-search that is still too deep is split again on the next facet given.
+# Facet values need not cover every item (items with no date, or facet lists that loc.gov
+# cuts short), so each split also gets a complement sub-search for the items with none of
+# the listed values, built from the filters' "not" URLs. Facet values can also overlap (an
+# item with two subjects is in both sub-searches), so the harvest writes each item once and
+# reconciles the distinct items it found against the search's hits.
+# Ex: hits, partitions, covered = plan_partitions(seed, ['dates', 'subject'], page_size=100, max_pages=100)
+
+import logging
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from locgov import locgov_search, bounded_map
+
+logger = logging.getLogger('locgov.partition')
+
+# Deepest sub-search, in pages, before it is split on the next facet
+DEFAULT_PARTITION_PAGES = 100
+
+# Arguments the harvest adds to a seed URL itself, taken off facet filter URLs
+SEARCH_ARGS = ['fo', 'at', 'c', 'sp', 'all']
+
+# One sub-search of a partitioned search
+# key is what the checkpoint records its pages under, the seed unless given
+class Partition:
+    def __init__(self, seed, hits, pages, label='', key=None):
+        self.seed = seed
+        self.hits = hits
+        self.pages = pages
+        self.label = label
+        self.key = key or seed
+
+    def __repr__(self):
+        return 'Partition(%r, hits=%d, pages=%d)' % (self.label or self.seed, self.hits, self.pages)
+
+# Seed URL for a facet filter URL, without the harvest's own arguments
+# Ex: https://www.loc.gov/collections/x/?dates=1900/1999&fo=json -> https://www.loc.gov/collections/x/?dates=1900/1999
+def filter_seed(url):
+    parts = urlsplit(url)
+    arguments = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name not in SEARCH_ARGS]
+    return '%s://%s%s?%s' % (parts.scheme, parts.netloc, parts.path, urlencode(arguments, safe=':/|'))
+
+# A search's facet, found by its type, field or title, None if the search has no such facet
+def find_facet(search_json, facet):
+    for entry in search_json.get('facets') or []:
+        names = [str(entry.get(key, '')).lower() for key in ('type', 'field', 'title')]
+        if facet.lower() in names:
+            return entry
+    return None
+
+# Filters of a search's facet, as (seed URL, count, title), empty if the search has no such facet
+def facet_filters(search_json, facet):
+    entry = find_facet(search_json, facet)
+    if entry is None:
+        return []
+    return [(filter_seed(facet_filter['on']), facet_filter.get('count', 0), facet_filter.get('title') or facet_filter.get('term'))
+        for facet_filter in entry.get('filters', []) if facet_filter.get('on')]
+
+# fa= filter terms of a URL, from every fa argument, each of which can join terms with |
+def fa_terms(url):
+    return [term for name, value in parse_qsl(urlsplit(url).query, keep_blank_values=True) if name == 'fa'
+        for term in value.split('|') if term]
+
+# Seed URL for the items of a search that have none of the values its facet lists (items with
+# no value, or one left off a list loc.gov cut short), adding every filter's "not" term to the seed
+# None if a filter has no "not" URL, or one that isn't an fa= term, so no complement can be built
+# Ex: https://www.loc.gov/collections/x/?fa=subject!:maps|subject!:music
+def complement_seed(seed, search_json, facet):
+    entry = find_facet(search_json, facet)
+    if entry is None:
+        return None
+    seed_terms = fa_terms(seed)
+    terms = []
+    for facet_filter in entry.get('filters', []):
+        if not facet_filter.get('not'):
+            return None
+        added = [term for term in fa_terms(facet_filter['not']) if term not in seed_terms]
+        if not added:
+            return None
+        terms += added
+    if not terms:
+        return None
+    parts = urlsplit(filter_seed(seed))
+    arguments = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name != 'fa']
+    arguments.append(('fa', '|'.join(seed_terms + terms)))
+    return '%s://%s%s?%s' % (parts.scheme, parts.netloc, parts.path, urlencode(arguments, safe=':/|!'))
+
+# Totals and facets of a search, from one page of no results' worth of fields
+def search_totals(seed, page_size):
+    return locgov_search(seed + '&fo=json&all=true&c=%d&at=pagination,search,facets' % page_size)
+
+# Split a search into partitions of no more than max_pages pages, as far as its facets allow
+# Sub-searches are sized (one request each, for their totals and facets) up to workers at a time
+# Returns (the search's hits, list of Partition, covered); a search that isn't too deep is one
+# partition, and covered is False if a split facet had no complement, so items may be left out
+def plan_partitions(seed, facets, page_size, max_pages=DEFAULT_PARTITION_PAGES, workers=1):
+    starter = search_totals(seed, page_size)
+    hits = starter['search']['hits']
+    partitions = []
+    covered = True
+    todo = [(Partition(seed, hits, starter['pagination']['total']), starter)]
+    for facet in facets:
+        splits = []
+        for partition, search in todo:
+            filters = []
+            if partition.pages > max_pages:
+                filters = facet_filters(search, facet)
+            if not filters:
+                partitions.append(partition)
+                continue
+            logger.info('Splitting %s (%d pages) on %s into %d sub-searches',
+                partition.label or partition.seed, partition.pages, facet, len(filters))
+            for filter_url, count, title in filters:
+                if count:
+                    splits.append((filter_url, ' > '.join(label for label in [partition.label, '%s: %s' % (facet, title)] if label)))
+            other_url = complement_seed(partition.seed, search, facet)
+            if other_url is None:
+                logger.warning('No complement for %s on %s, items without a listed value may be missed',
+                    partition.label or partition.seed, facet)
+                covered = False
+            else:
+                splits.append((other_url, ' > '.join(label for label in [partition.label, '%s: other' % facet] if label)))
+
+        def size(split):
+            filter_url, label = split
+            search = search_totals(filter_url, page_size)
+            return Partition(filter_url, search['search']['hits'], search['pagination']['total'], label), search
+        todo = [(partition, search) for partition, search in bounded_map(size, splits, workers) if partition.hits]
+    partitions += [partition for partition, search in todo]
+    return hits, partitions, covered
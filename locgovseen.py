@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Seen-sets for skipping items that an earlier query in the same run already harvested
+# Both kinds are safe to share between the page worker threads and have the same add()
+#   SeenItems: exact, holds an 8 byte digest of every item (roughly 70 bytes an item in Python)
+#   BloomSeenItems: fixed size Bloom filter for very large runs; a small fraction of new
+#     items (error_rate) are taken as seen and skipped, but memory stays at about 1.8 bytes
+#     an item for a 0.1% error rate however many are added
+# Ex: seen = SeenItems(); if seen.add(item_url): harvest it
+
+import hashlib
+import math
+import threading
+
+# Default sizing for BloomSeenItems
+DEFAULT_BLOOM_CAPACITY = 10000000
+DEFAULT_BLOOM_ERROR_RATE = 0.001
+
+def _digest(key):
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+class SeenItems:
+    def __init__(self):
+        self.items = set()
+        self.lock = threading.Lock()
+
+    # Add an item, returning True if it wasn't seen before
+    def add(self, key):
+        digest = int.from_bytes(_digest(key)[:8], 'little')
+        with self.lock:
+            if digest in self.items:
+                return False
+            self.items.add(digest)
+            return True
+
+    def __len__(self):
+        return len(self.items)
+
+class BloomSeenItems:
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Bit positions for a key, by double hashing one digest
+    def _positions(self, key):
+        digest = _digest(key)
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    # Add an item, returning True if it (probably) wasn't seen before
+    def add(self, key):
+        positions = self._positions(key)
+        with self.lock:
+            new = False
+            for position in positions:
+                byte, bit = divmod(position, 8)
+                if not self.bits[byte] & (1 << bit):
+                    self.bits[byte] |= 1 << bit
+                    new = True
+            if new:
+                self.count += 1
+            return new
+
+    def __len__(self):
+        return self.count
+
+# Make the seen-set for a --dedupe mode: 'exact', 'bloom', or 'off' for None
+def make_seen_items(mode, capacity=DEFAULT_BLOOM_CAPACITY):
+    if mode == 'exact':
+        return SeenItems()
+    if mode == 'bloom':
+        return BloomSeenItems(capacity)
+    return None
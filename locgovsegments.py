@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Segment statistics for resources in segments mode
+# A full resource's files are a list of segments (pages, tracks...), each a list of file
+# versions with a use, mimetype, size and url. One pass over them computes every aggregate
+# asked for, as the item's resources download, and only the aggregates are kept, not the files.
+# Each aggregate is a resource column:
+#   text: p1_resource_segment_with_text, files with use 'text' (the original segments mode column)
+#   files: p1_resource_file_count, every file version of every segment
+#   use: p1_resource_files_by_use, file count for each use, such as {'master': 4, 'text': 4}
+#   mimetype: p1_resource_files_by_mimetype, file count for each mimetype
+#   bytes: p1_resource_file_bytes, total size of the files that give one
+#   fulltext: p1_resource_has_fulltext_file, whether any file is full text
+#   iiif: p1_resource_has_iiif, whether any file is served by the IIIF image server
+# Ex: configure_segment_stats(['text', 'use', 'bytes'])
+
+STATS = {
+    'text': 'p1_resource_segment_with_text',
+    'files': 'p1_resource_file_count',
+    'use': 'p1_resource_files_by_use',
+    'mimetype': 'p1_resource_files_by_mimetype',
+    'bytes': 'p1_resource_file_bytes',
+    'fulltext': 'p1_resource_has_fulltext_file',
+    'iiif': 'p1_resource_has_iiif',
+}
+
+# Segments mode columns unless others are asked for
+DEFAULT_STATS = ['text']
+
+# Files that count as full text, by use or by mimetype
+FULLTEXT_USES = ['text']
+FULLTEXT_MIMETYPES = ['text/plain']
+
+# Part of the URL of a file served by the IIIF image server
+IIIF_URL_PART = '/iiif/'
+
+class SegmentStats:
+    def __init__(self, stats=DEFAULT_STATS):
+        for name in stats:
+            if name not in STATS:
+                raise ValueError('Unknown segment statistic: %s (known: %s)' % (name, ', '.join(STATS)))
+        # Always in the order of STATS, so the columns don't depend on how they were asked for
+        self.stats = [name for name in STATS if name in stats]
+        self.columns = [STATS[name] for name in self.stats]
+
+    # Aggregates of a full resource's files, as {column: value}
+    # A resource with no files (or one missing from the item's full resources) gets zero counts
+    def resource_stats(self, full_resource):
+        count_uses = 'use' in self.stats
+        count_mimetypes = 'mimetype' in self.stats
+        text = 0
+        files = 0
+        size = 0
+        uses = {}
+        mimetypes = {}
+        fulltext = False
+        iiif = False
+        for segment in full_resource.get('files') or []:
+            for file in segment:
+                files += 1
+                use = file.get('use')
+                mimetype = file.get('mimetype')
+                if use == 'text':
+                    text += 1
+                if count_uses and use is not None:
+                    uses[use] = uses.get(use, 0) + 1
+                if count_mimetypes and mimetype is not None:
+                    mimetypes[mimetype] = mimetypes.get(mimetype, 0) + 1
+                if isinstance(file.get('size'), int):
+                    size += file['size']
+                if use in FULLTEXT_USES or mimetype in FULLTEXT_MIMETYPES:
+                    fulltext = True
+                if IIIF_URL_PART in file.get('url', ''):
+                    iiif = True
+        values = {
+            'text': text,
+            'files': files,
+            'use': uses,
+            'mimetype': mimetypes,
+            'bytes': size,
+            'fulltext': fulltext,
+            'iiif': iiif,
+        }
+        return {STATS[name]: values[name] for name in self.stats}
+
+# Parse a comma separated list of statistics, or 'all'
+# The original text column is always kept
+def parse_segment_stats(text):
+    if text.strip() == 'all':
+        return list(STATS)
+    names = [name.strip() for name in text.split(',') if name.strip()]
+    if 'text' not in names:
+        names.insert(0, 'text')
+    return names
+
+_segment_stats = SegmentStats()
+
+# Return the shared SegmentStats that segments mode rows are built with
+def get_segment_stats():
+    return _segment_stats
+
+# Replace the shared SegmentStats, to compute other statistics
+def configure_segment_stats(stats):
+    global _segment_stats
+    _segment_stats = SegmentStats(stats)
+    return _segment_stats
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Sharded harvests of item lists (method 4) and query lists (method 5)
+# Every entry of the input list belongs to one of N shards by a hash of its value,
+# so processes or machines given the same list and shard count split it the same way
+# without talking to each other. Each shard writes its own item and resource outputs,
+# and merge_outputs combines them afterwards.
+# Ex: loc-gov-json.py --batch --method items --input items.csv --shard 2/4
+
+import hashlib
+import json
+import zlib
+from locgovwriters import open_output, make_writer, compression_of, output_format_of, output_columns, nested_output_columns, read_output
+
+# Parse a shard given as 'I/N', shard I (counting from 1) of N, into (I, N)
+def parse_shard(text):
+    try:
+        index, shards = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise ValueError('shard should be I/N, such as 2/4: %s' % text)
+    if shards < 1 or index < 1 or index > shards:
+        raise ValueError('shard should be I/N with I from 1 to N: %s' % text)
+    return index, shards
+
+# Shard number (from 1) for an input list value
+# crc32 rather than hash() so every process and machine agrees
+def shard_of(value, shards):
+    return zlib.crc32(value.strip().encode('utf-8')) % shards + 1
+
+def in_shard(value, shard):
+    index, shards = shard
+    return shard_of(value, shards) == index
+
+# Added to the output file names of a shard
+# Ex: OUTPUT-loc_gov_items-shard2of4-2024-05-01-10-00-00.csv
+def shard_suffix(shard):
+    return '-shard%dof%d' % shard
+
+# Merge shard outputs of one kind (all item files, or all resource files) into output_path
+# Columns are the union of the shards' columns in the order first seen, so shards run
+# with different options still line up; a row that is identical to one already written
+# (an item found by more than one query, say) is dropped
+# Each file is read in the compression of its extension, and must be in output_format: CSV
+# gives every value back as a string, so rows can't be carried over to another format as they are
+# output_format is the output's format, from the output_path extension if not given, and it is
+# compressed if output_path ends in a compression extension (.gz or .zst)
+# With max_rows or max_bytes the merged output is rotated into numbered part files
+# Raises ValueError for a file in another format
+# Returns (rows written, duplicate rows dropped)
+def merge_outputs(paths, output_path, output_format=None, max_rows=None, max_bytes=None):
+    if output_format is None:
+        output_format = output_format_of(output_path)
+    for path in paths:
+        if output_format_of(path) != output_format:
+            raise ValueError('Cannot merge %s into %s output: shard files must be in the output format' % (path, output_format))
+    fieldnames = []
+    nested_columns = []
+    for path in paths:
+        for fieldname in output_columns(path, output_format_of(path)):
+            if fieldname not in fieldnames:
+                fieldnames.append(fieldname)
+        for fieldname in nested_output_columns(path, output_format_of(path)):
+            if fieldname not in nested_columns:
+                nested_columns.append(fieldname)
+
+    seen = set()
+    written = 0
+    duplicates = 0
+    with open_output(output_path, output_format, compression=compression_of(output_path), max_rows=max_rows, max_bytes=max_bytes) as output:
+        writer = make_writer(output_format, output, fieldnames, nested_columns=nested_columns)
+        writer.writeheader()
+        for path in paths:
+            for row in read_output(path, output_format_of(path)):
+                key = row_key(row)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                writer.writerow(row)
+                written += 1
+        writer.close()
+    return written, duplicates
+
+# Short digest of a row's values for spotting duplicates without keeping the rows
+def row_key(row):
+    values = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(values.encode('utf-8'), digest_size=16).digest()
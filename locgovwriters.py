@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Output writers for the item and resource rows
+# Every writer takes the same row dicts through writeheader() / writerow(), like csv.DictWriter,
+# and is finished with close() before its file is closed
+#   csv: the original CSV output, list fields written as Python reprs
+#   jsonl: one JSON object per row, list fields kept as JSON lists
+#   parquet: batched columnar writes with real list columns (needs the optional pyarrow package)
+# CSV and JSON Lines outputs can be compressed as they are written (gzip, or zstd with the
+# optional zstandard package), and any output can be rotated into numbered part files
+# (RotatingOutput) so very large harvests are split into parts that load in parallel
+
+import csv
+import gzip
+import io
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File extension for each output format
+OUTPUT_FORMATS = {
+    'csv': '.csv',
+    'jsonl': '.jsonl',
+    'parquet': '.parquet',
+}
+
+# File extension added for each compression of CSV and JSON Lines outputs
+# Parquet is always compressed inside the file, so these don't apply to it
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Bytes buffered before a write to an output file or its compressor
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# Rows between size checks of a part file rotated by size
+ROTATE_CHECK_ROWS = 1000
+
+# Rows held in memory before a Parquet row group is written
+DEFAULT_BATCH_SIZE = 10000
+
+# Columns that hold lists of strings in loc.gov results
+LIST_COLUMNS = ['online_format', 'mime_type', 'partof', 'group', 'number_lccn', 'number_fileID', 'number_uuid']
+INT_COLUMNS = ['p1_resource_count', 'p1_resource_segment_count', 'p1_resource_segment_with_text', 'representative_index',
+    'p1_resource_file_count', 'p1_resource_file_bytes']
+BOOL_COLUMNS = ['digitized', 'has_fulltext', 'p1_resource_has_fulltext_file', 'p1_resource_has_iiif']
+# Columns that hold counts by name, such as the segment statistics' files by use
+MAP_COLUMNS = ['p1_resource_files_by_use', 'p1_resource_files_by_mimetype']
+
+class CsvWriter(csv.DictWriter):
+    def __init__(self, file, fieldnames):
+        super().__init__(file, fieldnames=fieldnames, lineterminator='\n')
+
+    def close(self):
+        pass
+
+class JsonLinesWriter:
+    def __init__(self, file, fieldnames):
+        self.file = file
+        self.fieldnames = fieldnames
+
+    def writeheader(self):
+        pass
+
+    # Columns missing from the row are written as null
+    def writerow(self, row):
+        record = {}
+        for fieldname in self.fieldnames:
+            record[fieldname] = row.get(fieldname)
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def close(self):
+        pass
+
+# Writes rows to a Parquet file in row groups of batch_size rows
+# nested_columns hold the item's list of resource summaries (the item output's p1_resource),
+# written as a list of structs; a marker such as 'NONE' or 'INVALID' becomes a one-entry list
+class ParquetWriter:
+    def __init__(self, file, fieldnames, nested_columns=(), batch_size=DEFAULT_BATCH_SIZE):
+        if pyarrow is None:
+            raise ImportError('Parquet output needs the pyarrow package')
+        self.fieldnames = fieldnames
+        self.nested_columns = nested_columns
+        self.batch_size = batch_size
+        self.schema = pyarrow.schema([(fieldname, self._column_type(fieldname)) for fieldname in fieldnames])
+        self.writer = pyarrow.parquet.ParquetWriter(file, self.schema, compression='zstd')
+        self.columns = {fieldname: [] for fieldname in fieldnames}
+        self.rows = 0
+
+    def _column_type(self, fieldname):
+        if fieldname in self.nested_columns:
+            return pyarrow.list_(pyarrow.struct([
+                ('p1_resource', pyarrow.string()),
+                ('p1_resource_caption', pyarrow.string()),
+                ('p1_resource_segment_count', pyarrow.int64()),
+            ]))
+        if fieldname in LIST_COLUMNS:
+            return pyarrow.list_(pyarrow.string())
+        if fieldname in MAP_COLUMNS:
+            return pyarrow.map_(pyarrow.string(), pyarrow.int64())
+        if fieldname in INT_COLUMNS:
+            return pyarrow.int64()
+        if fieldname in BOOL_COLUMNS:
+            return pyarrow.bool_()
+        return pyarrow.string()
+
+    # Convert a row value to fit its column; '' and missing values become null
+    def _column_value(self, fieldname, value):
+        if value is None or value == '':
+            return None
+        if fieldname in self.nested_columns:
+            if not isinstance(value, list):
+                return [{'p1_resource': str(value)}]
+            return [{
+                'p1_resource': summary.get('p1_resource'),
+                'p1_resource_caption': _string_value(summary.get('p1_resource_caption')),
+                'p1_resource_segment_count': _int_value(summary.get('p1_resource_segment_count')),
+            } for summary in value]
+        if fieldname in LIST_COLUMNS:
+            if not isinstance(value, list):
+                value = [value]
+            return [_string_value(v) for v in value]
+        if fieldname in MAP_COLUMNS:
+            if not isinstance(value, dict):
+                return None
+            return [(_string_value(name), _int_value(count)) for name, count in value.items()]
+        if fieldname in INT_COLUMNS:
+            return _int_value(value)
+        if fieldname in BOOL_COLUMNS:
+            return bool(value)
+        return _string_value(value)
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        for fieldname in self.fieldnames:
+            self.columns[fieldname].append(self._column_value(fieldname, row.get(fieldname)))
+        self.rows += 1
+        if self.rows >= self.batch_size:
+            self.flush()
+
+    # Write the buffered rows as a row group
+    def flush(self):
+        if self.rows == 0:
+            return
+        table = pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table)
+        self.columns = {fieldname: [] for fieldname in self.fieldnames}
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def _string_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+def _int_value(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# Open an output file in the right mode for its format
+# mode is 'w' for a new file or 'a' to append to a resumed one
+# compression is None or one of COMPRESSIONS, for CSV and JSON Lines
+# With max_rows or max_bytes the output is a RotatingOutput of numbered part files
+def open_output(path, output_format, mode='w', compression=None, max_rows=None, max_bytes=None):
+    if max_rows or max_bytes:
+        return RotatingOutput(path, output_format, compression, max_rows, max_bytes)
+    return _open_file(path, output_format, mode, compression)
+
+def _open_file(path, output_format, mode, compression):
+    if output_format == 'parquet':
+        return open(path, mode + 'b', buffering=OUTPUT_BUFFER_SIZE)
+    encoding = 'utf-8-sig'
+    if output_format == 'jsonl':
+        encoding = 'utf-8'
+    if compression is None:
+        return open(path, mode, encoding=encoding, buffering=OUTPUT_BUFFER_SIZE)
+    if compression == 'gzip':
+        compressed = gzip.open(path, mode + 'b', compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+        compressed = zstandard.ZstdCompressor(level=3).stream_writer(open(path, mode + 'b'))
+    else:
+        raise ValueError('Unknown compression: %s' % compression)
+    # The buffer hands the compressor large blocks rather than every row
+    return io.TextIOWrapper(io.BufferedWriter(compressed, OUTPUT_BUFFER_SIZE), encoding=encoding)
+
+# Open an output file for reading, decompressing it by its extension
+def _open_read(path, encoding):
+    compression = compression_of(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding=encoding, newline='')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding=encoding, newline='')
+    return open(path, 'r', encoding=encoding, newline='')
+
+# An output split into numbered part files, a new part started once the current one has
+# max_rows rows or about max_bytes bytes on disk (checked every ROTATE_CHECK_ROWS rows)
+# Ex: OUTPUT-loc_gov_items-2024-05-01-10-00-00.part0001.csv.gz, ...part0002.csv.gz
+# make_writer gives a RotatingWriter for it, which starts every part with the header
+class RotatingOutput:
+    def __init__(self, path, output_format, compression=None, max_rows=None, max_bytes=None):
+        self.path = path
+        self.output_format = output_format
+        self.compression = compression
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.file = None
+        self.rows = 0
+        self.next_part()
+
+    def part_path(self, part):
+        base, extension = split_output_path(self.path)
+        return '%s.part%04d%s' % (base, part, extension)
+
+    # Close the current part and start the next
+    def next_part(self):
+        if self.file is not None:
+            self.file.close()
+        self.paths.append(self.part_path(len(self.paths) + 1))
+        self.file = _open_file(self.paths[-1], self.output_format, 'w', self.compression)
+        self.rows = 0
+
+    # Count a row written to the current part
+    def row_written(self):
+        self.rows += 1
+
+    # True when the current part has reached its size, so the next row starts a new part
+    def full(self):
+        if self.max_rows and self.rows >= self.max_rows:
+            return True
+        if self.max_bytes and self.rows and self.rows % ROTATE_CHECK_ROWS == 0:
+            # Flushed so the size counts what is waiting in the buffer and compressor
+            self.file.flush()
+            return os.fstat(self.file.fileno()).st_size >= self.max_bytes
+        return False
+
+    # flush() and fileno() are for the current part, as a checkpoint uses them
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Writer for a RotatingOutput: a new writer from make_part_writer for each part
+class RotatingWriter:
+    def __init__(self, output, make_part_writer):
+        self.output = output
+        self.make_part_writer = make_part_writer
+        self.writer = make_part_writer(output.file)
+        self.header = False
+
+    def writeheader(self):
+        self.header = True
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        if self.output.full():
+            self.writer.close()
+            self.output.next_part()
+            self.writer = self.make_part_writer(self.output.file)
+            if self.header:
+                self.writer.writeheader()
+        self.writer.writerow(row)
+        self.output.row_written()
+
+    def close(self):
+        self.writer.close()
+
+# Split an output path into the name and its extension, including any compression
+# Ex: 'items.csv.gz' -> ('items', '.csv.gz')
+def split_output_path(path):
+    base, extension = os.path.splitext(path)
+    if extension.lower() in COMPRESSIONS.values():
+        base, format_extension = os.path.splitext(base)
+        extension = format_extension + extension
+    return base, extension
+
+# Compression of an output file from its extension, None if it isn't compressed
+def compression_of(path):
+    extension = os.path.splitext(path)[1].lower()
+    for compression, compression_extension in COMPRESSIONS.items():
+        if extension == compression_extension:
+            return compression
+    return None
+
+# Format of an output file from its extension, None if it isn't one of OUTPUT_FORMATS
+# A compression extension after the format's is allowed, as in items.csv.gz
+def output_format_of(path):
+    if compression_of(path) is not None:
+        path = os.path.splitext(path)[0]
+    extension = os.path.splitext(path)[1].lower()
+    for output_format, format_extension in OUTPUT_FORMATS.items():
+        if extension == format_extension:
+            return output_format
+    return None
+
+# Column names of an existing output file, in file order
+# JSON Lines files have no header, so their columns come from the first row
+def output_columns(path, output_format):
+    if output_format == 'parquet':
+        return pyarrow.parquet.read_schema(path).names
+    if output_format == 'jsonl':
+        with _open_read(path, 'utf-8') as file:
+            for line in file:
+                return list(json.loads(line))
+        return []
+    with _open_read(path, 'utf-8-sig') as file:
+        return next(csv.reader(file), [])
+
+# Columns of an existing Parquet output written as lists of resource summaries (nested_columns)
+def nested_output_columns(path, output_format):
+    if output_format != 'parquet':
+        return []
+    schema = pyarrow.parquet.read_schema(path)
+    return [field.name for field in schema
+        if pyarrow.types.is_list(field.type) and pyarrow.types.is_struct(field.type.value_type)]
+
+# Yield the rows of an existing output file as dicts, decompressing it by its extension
+# CSV values come back as the strings that were written, including list reprs
+def read_output(path, output_format):
+    if output_format == 'parquet':
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        # pyarrow gives map columns as lists of (key, value) pairs
+        map_columns = [field.name for field in parquet_file.schema_arrow if pyarrow.types.is_map(field.type)]
+        for batch in parquet_file.iter_batches(batch_size=DEFAULT_BATCH_SIZE):
+            for row in batch.to_pylist():
+                for column in map_columns:
+                    if row[column] is not None:
+                        row[column] = dict(row[column])
+                yield row
+    elif output_format == 'jsonl':
+        with _open_read(path, 'utf-8') as file:
+            for line in file:
+                yield json.loads(line)
+    else:
+        with _open_read(path, 'utf-8-sig') as file:
+            yield from csv.DictReader(file)
+
+# Make the writer for an output format on a file from open_output
+def make_writer(output_format, file, fieldnames, nested_columns=()):
+    if isinstance(file, RotatingOutput):
+        return RotatingWriter(file, lambda part_file: make_writer(output_format, part_file, fieldnames, nested_columns))
+    if output_format == 'parquet':
+        return ParquetWriter(file, fieldnames, nested_columns)
+    if output_format == 'jsonl':
+        return JsonLinesWriter(file, fieldnames)
+    return CsvWriter(file, fieldnames)